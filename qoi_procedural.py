@@ -1,13 +1,50 @@
-from itertools import repeat, chain, compress, cycle
-from struct import pack, unpack_from
-from typing import Generator
+from array import array
+from bisect import bisect_right
+from itertools import chain
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import ExitStack, contextmanager
+from multiprocessing.shared_memory import SharedMemory
+from os import PathLike
+from struct import calcsize, pack_into, unpack_from
+from typing import BinaryIO, Iterable, Iterator, NamedTuple, Union
+import mmap
+import os
+import sys
+import traceback
 import warnings
 
+try:
+    from collections.abc import Buffer  # Python 3.12+
+except ImportError:
+    Buffer = bytes  # Older type checkers treat bytes as any bytes-like object.
+
+try:
+    import numpy as np
+except ImportError:  # NumPy is optional; only the numpy backend needs it.
+    np = None
+
 
 CHANNELS_RGB = 3
 CHANNELS_RGBA = 4
 COLORSPACE_SRGB_WITH_LINEAR_ALPHA = 0
 COLORSPACE_ALL_CHANNELS_LINEAR = 1
+BACKEND_PYTHON = 'python'
+BACKEND_NUMPY = 'numpy'  # Falls back to BACKEND_PYTHON if NumPy isn't installed.
+FORMAT_RAW = 'raw'
+FORMAT_PAM = 'pam'
+FORMAT_PPM = 'ppm'  # RGB only; alpha is dropped.
+# Pixel layouts; for the channel orders the value is the order itself.
+LAYOUT_RGB = 'rgb'
+LAYOUT_RGBA = 'rgba'
+LAYOUT_BGR = 'bgr'
+LAYOUT_BGRA = 'bgra'
+LAYOUT_ARGB = 'argb'
+LAYOUT_BGRX = 'bgrx'  # Input only; X is ignored.
+LAYOUT_ALPHA = 'a'
+LAYOUT_GRAY = 'gray'  # Luma, ITU-R BT.601 weights.
+LAYOUT_GRAY_ALPHA = 'gray_alpha'  # Input only.
+LAYOUT_RGB565 = 'rgb565'  # 16 bits per pixel, little-endian.
+LAYOUT_RGBA_PREMULTIPLIED = 'rgba_premultiplied'
 
 TAG_QOI_OP_RGB = 0xfe
 TAG_QOI_OP_RGBA = 0xff
@@ -18,36 +55,87 @@ TAG_QOI_OP_RUN = 0b11 << 6
 
 TAG_QOI_2B_MASK = 0xc0
 
+QOI_HEADER_SIZE = 14
+QOI_END_MARKER = b'\x00'*7 + b'\x01'
+CHECKPOINTS_MAGIC = b'qoic'
+CHECKPOINT_FORMAT = '>QQ4s256s'  # offset, pixel, prev pixel (RGBA), index (64 RGBA)
+INDEX_TRAILER_MAGIC = b'qoix'
+TILED_MAGIC = b'qoit'
+TILED_HEADER_FORMAT = '>4sIIIIBB'  # magic, width, height, tile width, tile height, channels, colorspace
+TILE_ENTRY_FORMAT = '>QQ'  # offset, length
+MIN_STRIP_PIXELS = 1 << 16  # Smallest strip qoi_encode(..., workers=N) splits off.
+NUMPY_MAX_INDEX_SHARE = 1 / 16  # Share of INDEX ops above which BACKEND_NUMPY decodes with the Python loop.
+
+# Internally a pixel is its 4 RGBA bytes read as one native 32-bit word
+# (memoryview(...).cast('I')), so the channel positions depend on byte order.
+if sys.byteorder == 'little':
+    SHIFT_R, SHIFT_G, SHIFT_B, SHIFT_A = 0, 8, 16, 24
+else:
+    SHIFT_R, SHIFT_G, SHIFT_B, SHIFT_A = 24, 16, 8, 0
+
 
 qoi_index_position = lambda r, g, b, a: (r*3 + g*5 + b*7 + a*11) % 64
 s8_arith = lambda x: ((128+x) % 256) - 128
 u8_arith = lambda x: x % 256
+pack_pixel = lambda r, g, b, a: r<<SHIFT_R | g<<SHIFT_G | b<<SHIFT_B | a<<SHIFT_A
+unpack_pixel = lambda v: ((v>>SHIFT_R) & 0xff, (v>>SHIFT_G) & 0xff, (v>>SHIFT_B) & 0xff, (v>>SHIFT_A) & 0xff)
+
+
+def byte_view(data: Buffer) -> memoryview:
+    # Flat unsigned byte view of any C-contiguous buffer (bytes, bytearray,
+    # mmap, array.array, NumPy arrays, ...) without copying it.
+    view = memoryview(data)
+    if not view.c_contiguous:
+        raise ValueError('data must be a C-contiguous buffer.')
+    return view if view.format == 'B' and view.ndim == 1 else view.cast('B')
 
 
-def pixels(data: bytes, channels: int) -> Generator[tuple[int, int, int, int], None, None]:
-    data_iter = iter(data)
+@contextmanager
+def releasing_views():
+    # Views of a memory map or shared memory block that live on in the frames
+    # of an exception's traceback keep it from closing, and the BufferError
+    # would hide the real error. Keeps the traceback but drops the locals.
     try:
-        while True:
-            yield (
-                next(data_iter),
-                next(data_iter),
-                next(data_iter),
-                255 if channels==CHANNELS_RGB else next(data_iter)
-            )
-    except StopIteration:
-        pass
+        yield
+    except BaseException as e:
+        traceback.clear_frames(e.__traceback__)
+        raise
 
 
-def qoi_encode(
-        width: int,
-        height: int,
-        data: bytes,
-        channels=CHANNELS_RGB,
-        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA) -> bytes:
-    TOTAL_PIXELS = width*height
-    prev_pixel = (0, 0, 0, 255)
-    indexed_pixels = [(0, 0, 0, 0)] * 64
+def packed_pixels(data: memoryview, channels: int, count: int) -> memoryview:
+    if channels == CHANNELS_RGBA:
+        return data[:count*4].cast('I')
+    # Widen RGB to RGBA (alpha 255) with C-level strided copies.
+    rgba = bytearray(b'\xff') * (count*4)
+    rgba[0::4] = data[0:count*3:3]
+    rgba[1::4] = data[1:count*3:3]
+    rgba[2::4] = data[2:count*3:3]
+    return memoryview(rgba).cast('I')
+
 
+def packed_chunks(data: memoryview, channels: int, count: int) -> Iterator[memoryview]:
+    # packed_pixels of count pixels, CONVERT_CHUNK_PIXELS at a time: RGB is
+    # widened into one reused chunk buffer instead of a copy of the whole
+    # image. A chunk is only valid until the next one is requested.
+    if channels == CHANNELS_RGBA:
+        yield packed_pixels(data, channels, count)
+        return
+    rgba = bytearray(b'\xff') * (min(count, CONVERT_CHUNK_PIXELS)*4)
+    with memoryview(rgba).cast('I') as words:
+        for start in range(0, count, CONVERT_CHUNK_PIXELS):
+            n = min(CONVERT_CHUNK_PIXELS, count - start)
+            rgba[0:n*4:4] = data[start*3:(start + n)*3:3]
+            rgba[1:n*4:4] = data[start*3 + 1:(start + n)*3:3]
+            rgba[2:n*4:4] = data[start*3 + 2:(start + n)*3:3]
+            yield words[:n]
+
+
+def qoi_max_encoded_size(width: int, height: int, channels=CHANNELS_RGB) -> int:
+    # Worst case every pixel is a full QOI_OP_RGB(A): 1 tag byte + channels.
+    return QOI_HEADER_SIZE + width*height*(channels+1) + len(QOI_END_MARKER)
+
+
+def check_header_args(width: int, height: int, channels: int, colorspace: int):
     if width <= 0:
         raise ValueError('width must be larger than 0.')
     if height <= 0:
@@ -56,134 +144,1947 @@ def qoi_encode(
         raise ValueError(f'channels must be CHANNELS_RGB ({CHANNELS_RGB}) or CHANNELS_RGBA ({CHANNELS_RGBA}).')
     if colorspace not in (COLORSPACE_SRGB_WITH_LINEAR_ALPHA, COLORSPACE_ALL_CHANNELS_LINEAR):
         raise ValueError(f'colorspace must be COLORSPACE_SRGB_WITH_LINEAR_ALPHA ({COLORSPACE_SRGB_WITH_LINEAR_ALPHA}) or COLORSPACE_ALL_CHANNELS_LINEAR ({COLORSPACE_ALL_CHANNELS_LINEAR}).')
-    if len(data) < (TOTAL_PIXELS * channels):
-        raise ValueError(f'data is too short. Exp: {TOTAL_PIXELS*channels}, Act: {len(data)}')
 
-    output = []
-    output.append(pack('>4sIIBB', b'qoif', width, height, channels, colorspace))
 
-    run_count = 0
-    for pixel in pixels(data, channels):
+def check_encode_args(width: int, height: int, data: memoryview, channels: int, colorspace: int, backend: str):
+    check_header_args(width, height, channels, colorspace)
+    if len(data) < (width*height * channels):
+        raise ValueError(f'data is too short. Exp: {width*height*channels}, Act: {len(data)}')
+    if backend not in (BACKEND_PYTHON, BACKEND_NUMPY):
+        raise ValueError(f'backend must be BACKEND_PYTHON ({BACKEND_PYTHON!r}) or BACKEND_NUMPY ({BACKEND_NUMPY!r}).')
+
+
+# Input layouts as channel orders; l is gray, used for each of r, g and b.
+INPUT_ORDERS = {
+    LAYOUT_RGB: 'rgb',
+    LAYOUT_RGBA: 'rgba',
+    LAYOUT_BGR: 'bgr',
+    LAYOUT_BGRA: 'bgra',
+    LAYOUT_BGRX: 'bgrx',
+    LAYOUT_ARGB: 'argb',
+    LAYOUT_GRAY: 'l',
+    LAYOUT_GRAY_ALPHA: 'la',
+    LAYOUT_RGBA_PREMULTIPLIED: 'rgba',
+}
+unpremultiply_pixel = lambda r, g, b, a: pack_pixel(*[(min(255, (c*255 + a//2) // a) if a else 0) for c in (r, g, b)], a)
+
+
+def layout_pixels(data: memoryview, layout: str, channels: int, count: int) -> memoryview:
+    # Converts count pixels in an input layout to the RGB(A) bytes the
+    # encoder reads, with C-level strided copies (a missing alpha is 255).
+    # Premultiplied colors are divided by alpha through a PixelTable,
+    # CONVERT_CHUNK_PIXELS at a time, straight into the output.
+    source = INPUT_ORDERS[layout]
+    target = 'rgba'[:channels]
+    output = bytearray(count*channels)
+    if layout == LAYOUT_RGBA_PREMULTIPLIED:
+        table = PixelTable(unpremultiply_pixel)
+        for start in range(0, count, CONVERT_CHUNK_PIXELS):
+            n = min(CONVERT_CHUNK_PIXELS, count - start)
+            words = array('I', map(table.__getitem__, data[start*4:(start + n)*4].cast('I')))
+            convert_pixels_into(memoryview(words).cast('B'), CHANNELS_RGBA, n, target, output, start*channels)
+        return memoryview(output)
+    if source == target:
+        return data
+
+    for (i, channel) in enumerate(target):
+        if channel not in source and channel != 'a':
+            channel = 'l'
+        if channel in source:
+            output[i::channels] = data[source.index(channel):count*len(source):len(source)]
+        else:
+            output[i::channels] = b'\xff' * count
+    return memoryview(output)
+
+
+def qoi_encode(
+        width: int,
+        height: int,
+        data: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA,
+        backend=BACKEND_PYTHON,
+        workers=None,
+        layout=None) -> bytes:
+    data = byte_view(data)
+    if layout is not None:
+        # data is in layout; channels is still what the qoi image stores.
+        if layout not in INPUT_ORDERS:
+            raise ValueError(f'layout must be None or one of {tuple(INPUT_ORDERS)}.')
+        check_header_args(width, height, channels, colorspace)
+        size = width*height*len(INPUT_ORDERS[layout])
+        if len(data) < size:
+            raise ValueError(f'data is too short. Exp: {size}, Act: {len(data)}')
+        data = layout_pixels(data, layout, channels, width*height)
+    check_encode_args(width, height, data, channels, colorspace, backend)
+
+    if backend == BACKEND_NUMPY and np is not None:
+        return qoi_encode_numpy(width, height, data, channels, colorspace)
+
+    # Only split images big enough to be worth the processes.
+    strips = min(workers or 1, height, (width*height) // MIN_STRIP_PIXELS)
+    if strips > 1:
+        return qoi_encode_strips(width, height, data, channels, colorspace, strips)
+
+    output = bytearray(qoi_max_encoded_size(width, height, channels))
+    size = encode_ops(width, height, data, output, channels, colorspace)
+
+    # Single trim/copy of the used part of the buffer.
+    return bytes(memoryview(output)[:size])
+
+
+def qoi_encode_into(
+        width: int,
+        height: int,
+        data: Buffer,
+        out: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA,
+        backend=BACKEND_PYTHON) -> int:
+    data = byte_view(data)
+    check_encode_args(width, height, data, channels, colorspace, backend)
+    output = byte_view(out)
+    if output.readonly:
+        raise ValueError('out must be a writable buffer.')
+    if len(output) < QOI_HEADER_SIZE + len(QOI_END_MARKER):
+        # Not even the header and end marker fit (pack_into would raise struct.error).
+        raise ValueError(f'out is too small. Max: {qoi_max_encoded_size(width, height, channels)}, Act: {len(output)}')
+
+    if backend == BACKEND_NUMPY and np is not None:
+        encoded = qoi_encode_numpy(width, height, data, channels, colorspace)
+        if len(encoded) > len(output):
+            raise ValueError(f'out is too small. Exp: {len(encoded)}, Act: {len(output)}')
+        output[:len(encoded)] = encoded
+        return len(encoded)
+
+    try:
+        return encode_ops(width, height, data, output, channels, colorspace)
+    except (IndexError, ValueError):
+        # A write ran past the end of out (memoryviews never grow).
+        raise ValueError(f'out is too small. Max: {qoi_max_encoded_size(width, height, channels)}, Act: {len(output)}') from None
+
+
+def encode_ops(width: int, height: int, data: memoryview, output: Buffer, channels: int, colorspace: int) -> int:
+    # Writes the header, ops and end marker into output and returns the
+    # number of bytes written. Arguments are expected to be validated.
+    indexed_pixels = array('I', bytes(4*64))
+    pack_into('>4sIIBB', output, 0, b'qoif', width, height, channels, colorspace)
+    (pos, prev_pixel, run_count) = (QOI_HEADER_SIZE, pack_pixel(0, 0, 0, 255), 0)
+    for pixels in packed_chunks(data, channels, width*height):
+        (pos, prev_pixel, run_count) = encode_pixel_ops(pixels, output, pos, indexed_pixels, prev_pixel, run_count)
+    return encode_end(output, pos, run_count)
+
+
+def encode_end(output: Buffer, pos: int, run_count: int) -> int:
+    # Check the run_count one more time in case it was the final set of pixels
+    if run_count > 0:
+        output[pos] = TAG_QOI_OP_RUN | (run_count-1)  # bias -1
+        pos += 1
+
+    output[pos:pos+8] = QOI_END_MARKER
+    return pos + 8
+
+
+def encode_pixel_ops(
+        pixels: memoryview,
+        output: Buffer,
+        pos: int,
+        indexed_pixels: array,
+        prev_pixel: int,
+        run_count: int,
+        first_writes: Union[list, None] = None) -> tuple[int, int, int]:
+    # Encodes packed pixels into output starting at pos. The encoder state
+    # (indexed_pixels is updated in place, prev_pixel, run_count) carries
+    # over between calls; returns the new (pos, prev_pixel, run_count).
+    # If first_writes is a list, (op start, pixel) is appended to it for
+    # every op that replaces an UNKNOWN_INDEX entry (see encode_strip).
+
+    # Local copies for the hot loop.
+    sr, sg, sb, sa = SHIFT_R, SHIFT_G, SHIFT_B, SHIFT_A
+    (pr, pg, pb, pa) = unpack_pixel(prev_pixel)
+
+    for pixel in pixels:
         if pixel == prev_pixel:
             run_count += 1
             if run_count == 62:
-                output.append(pack('>B', TAG_QOI_OP_RUN | 61))  # 62 bias -1 => 61
+                output[pos] = TAG_QOI_OP_RUN | 61  # 62 bias -1 => 61
+                pos += 1
                 run_count = 0
         else:
             if run_count > 0:
-                output.append(pack('>B', TAG_QOI_OP_RUN | (run_count-1)))  # bias -1
+                output[pos] = TAG_QOI_OP_RUN | (run_count-1)  # bias -1
+                pos += 1
                 run_count = 0
                 # Continue to the next OP check because we have updated pixel
 
-            prev_index = qoi_index_position(*pixel)
+            r = (pixel >> sr) & 0xff
+            g = (pixel >> sg) & 0xff
+            b = (pixel >> sb) & 0xff
+            a = (pixel >> sa) & 0xff
+            prev_index = (r*3 + g*5 + b*7 + a*11) % 64  # qoi_index_position
             if pixel == indexed_pixels[prev_index]:
                 # QOI_OP_INDEX
-                output.append(pack('>B', TAG_QOI_OP_INDEX | prev_index))
-            elif prev_pixel[3] != pixel[3]:
-                # QOI_OP_RGBA - it is the only option left if alpha is different
-                output.append(pack('>BBBBB', TAG_QOI_OP_RGBA, *pixel))
-                indexed_pixels[prev_index] = pixel
+                output[pos] = TAG_QOI_OP_INDEX | prev_index
+                pos += 1
             else:
-                dr = s8_arith(pixel[0] - prev_pixel[0])
-                dg = s8_arith(pixel[1] - prev_pixel[1])
-                db = s8_arith(pixel[2] - prev_pixel[2])
-
-                dr_dg = s8_arith(dr - dg)
-                db_dg = s8_arith(db - dg)
-
-                if ((-2<=dr<=1) and (-2<=dg<=1) and (-2<=db<=1)):
-                    # QOI_OP_DIFF
-                    output.append(pack('>B', TAG_QOI_OP_DIFF | (dr+2)<<4 | (dg+2)<<2 | (db+2)))
-                    indexed_pixels[prev_index] = pixel
-                elif ((-32<=dg<=31) and (-8<=dr_dg<=7) and (-8<=db_dg<=7)):
-                    # QOI_OP_LUMA
-                    output.append(pack('>BB', TAG_QOI_OP_LUMA | dg+32, (dr_dg+8)<<4 | (db_dg+8)))
-                    indexed_pixels[prev_index] = pixel
+                if first_writes is not None and indexed_pixels[prev_index] == UNKNOWN_INDEX[prev_index]:
+                    first_writes.append((pos, pixel))
+                    if len(first_writes) == 64:
+                        first_writes = None  # All slots are written; stop checking.
+                indexed_pixels[prev_index] = pixel
+                if pa != a:
+                    # QOI_OP_RGBA - it is the only option left if alpha is different
+                    output[pos] = TAG_QOI_OP_RGBA
+                    output[pos+1] = r
+                    output[pos+2] = g
+                    output[pos+3] = b
+                    output[pos+4] = a
+                    pos += 5
                 else:
-                    # QOI_OP_RGB
-                    output.append(pack('>BBBB', TAG_QOI_OP_RGB, *pixel[:3]))
-                    indexed_pixels[prev_index] = pixel
+                    # s8_arith, inlined
+                    dr = ((r - pr + 128) % 256) - 128
+                    dg = ((g - pg + 128) % 256) - 128
+                    db = ((b - pb + 128) % 256) - 128
+
+                    if ((-2<=dr<=1) and (-2<=dg<=1) and (-2<=db<=1)):
+                        # QOI_OP_DIFF
+                        output[pos] = TAG_QOI_OP_DIFF | (dr+2)<<4 | (dg+2)<<2 | (db+2)
+                        pos += 1
+                    else:
+                        dr_dg = ((dr - dg + 128) % 256) - 128
+                        db_dg = ((db - dg + 128) % 256) - 128
+                        if ((-32<=dg<=31) and (-8<=dr_dg<=7) and (-8<=db_dg<=7)):
+                            # QOI_OP_LUMA
+                            output[pos] = TAG_QOI_OP_LUMA | dg+32
+                            output[pos+1] = (dr_dg+8)<<4 | (db_dg+8)
+                            pos += 2
+                        else:
+                            # QOI_OP_RGB
+                            output[pos] = TAG_QOI_OP_RGB
+                            output[pos+1] = r
+                            output[pos+2] = g
+                            output[pos+3] = b
+                            pos += 4
 
             prev_pixel = pixel
+            pr, pg, pb, pa = r, g, b, a
+
+    return pos, prev_pixel, run_count
+
+
+# Index table for a strip whose incoming index is unknown: every slot holds a
+# pixel that hashes to a different slot, so it can never be an INDEX hit.
+UNKNOWN_INDEX = array('I', [pack_pixel(0 if slot else 1, 0, 0, 0) for slot in range(64)])
+op_length = lambda tag: 5 if tag == TAG_QOI_OP_RGBA else 4 if tag == TAG_QOI_OP_RGB else 2 if (tag & TAG_QOI_2B_MASK) == TAG_QOI_OP_LUMA else 1
+
+
+def encode_strip(pixels: memoryview, prev_pixel: int) -> tuple:
+    # Speculatively encodes a strip of packed pixels of a bigger image. Only
+    # the previous pixel is known (it is part of the image), the incoming
+    # run_count and index are not. So the leading run is left to the caller,
+    # and the first non-run pixel of each index slot (the only ops that read
+    # the incoming index) is encoded as a miss, with its op's byte range
+    # recorded for the repair in qoi_encode_strips.
+    count = len(pixels)
+    lead = 0
+    while lead < count and pixels[lead] == prev_pixel:
+        lead += 1
+
+    # Every slot starts out as UNKNOWN_INDEX, so the first pixel of each is
+    # a miss; the encoder records where their ops start.
+    output = bytearray(count*5)  # QOI_OP_RGBA for every pixel at worst
+    indexed_pixels = array('I', UNKNOWN_INDEX)
+    first_writes = []
+    (pos, prev_pixel, run_count) = encode_pixel_ops(
+        pixels[lead:], output, 0, indexed_pixels, prev_pixel, 0, first_writes)
+    guesses = [(start, start + op_length(output[start]), pixel) for (start, pixel) in first_writes]
+
+    return (lead, bytes(memoryview(output)[:pos]), guesses, indexed_pixels.tobytes(), run_count)
+
+
+def encode_shared_strip(name: str, channels: int, start: int, end: int) -> tuple:
+    # Runs in a worker process of qoi_encode_strips on pixels [start, end)
+    # of the image in a shared memory block.
+    shared = SharedMemory(name=name)
+    try:
+        first = max(start-1, 0)
+        with shared.buf[first*channels:end*channels] as data, releasing_views():
+            pixels = packed_pixels(data, channels, end-first)
+            try:
+                prev_pixel = pixels[0] if start > 0 else pack_pixel(0, 0, 0, 255)
+                return encode_strip(pixels[start-first:], prev_pixel)
+            finally:
+                pixels.release()
+    finally:
+        shared.close()
+
+
+def qoi_encode_strips(width: int, height: int, data: memoryview, channels: int, colorspace: int, strips: int) -> bytes:
+    # Encodes horizontal strips in parallel with encode_strip, then stitches
+    # them in order: only the previous pixel, run_count and index cross a
+    # strip boundary, so the output is byte-identical to the serial encoder.
+    # The stitch rewrites each leading run with the incoming run_count and
+    # turns guessed ops into QOI_OP_INDEX where the incoming index hits.
+    size = width*height*channels
+    shared = SharedMemory(create=True, size=size)
+    try:
+        shared.buf[:size] = data[:size]
+        bounds = [height*i // strips * width for i in range(strips+1)]
+        with ProcessPoolExecutor(strips) as pool:
+            results = list(pool.map(
+                encode_shared_strip, [shared.name]*strips, [channels]*strips, bounds[:-1], bounds[1:]))
+    finally:
+        shared.close()
+        shared.unlink()
+
+    output = bytearray(QOI_HEADER_SIZE)
+    pack_into('>4sIIBB', output, 0, b'qoif', width, height, channels, colorspace)
+    indexed_pixels = array('I', bytes(4*64))
+    run_count = 0
+    for (lead, ops, guesses, strip_index, strip_run_count) in results:
+        run_count += lead
+        output += bytes([TAG_QOI_OP_RUN | 61]) * (run_count // 62)
+        run_count %= 62
+        if not ops:
+            continue  # The whole strip continues the run.
+        if run_count > 0:
+            output.append(TAG_QOI_OP_RUN | (run_count-1))
+
+        ops = bytearray(ops)
+        for (op_start, op_end, pixel) in reversed(guesses):
+            slot = qoi_index_position(*unpack_pixel(pixel))
+            if indexed_pixels[slot] == pixel:
+                ops[op_start:op_end] = bytes([TAG_QOI_OP_INDEX | slot])
+        output += ops
+
+        for (slot, pixel) in enumerate(array('I', strip_index)):
+            if qoi_index_position(*unpack_pixel(pixel)) == slot:
+                indexed_pixels[slot] = pixel  # Written by the strip
+        run_count = strip_run_count
 
-    # Check the run_count one more time in case it was the final set of pixels
     if run_count > 0:
-        output.append(pack('>B', TAG_QOI_OP_RUN | (run_count-1)))  # bias -1
+        output.append(TAG_QOI_OP_RUN | (run_count-1))
+    output += QOI_END_MARKER
+    return bytes(output)
 
-    output.append(b'\x00'*7 + b'\x01')
 
-    return b''.join(output)
+class QoiEncoder:
+    # Incremental encoder: pixel data is fed in arbitrarily sized chunks and
+    # the encoded bytes are returned as soon as they are ready, so memory use
+    # doesn't depend on the image size.
 
+    def __init__(
+            self,
+            width: int,
+            height: int,
+            channels=CHANNELS_RGB,
+            colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA):
+        check_header_args(width, height, channels, colorspace)
+        self.width = width
+        self.height = height
+        self.channels = channels
+        self.colorspace = colorspace
+        self.pixels_fed = 0
+        self._partial_pixel = bytearray()
+        self._prev_pixel = pack_pixel(0, 0, 0, 255)
+        self._run_count = 0
+        self._indexed_pixels = array('I', bytes(4*64))
+        self._header_sent = False
+        self._finished = False
 
-def qoi_decode(data: bytes) -> bytes:
-    output = []
-    header = unpack_from('>4sIIBB', data, 0)
-    (footer,) = unpack_from('8s', data, len(data)-8)
-    (magic, width, height, channels, colorspace) = header
+    def feed(self, data: Buffer) -> bytes:
+        if self._finished:
+            raise ValueError('feed() called after finish().')
+        data = byte_view(data)
+        channels = self.channels
+        # Checked before any state changes, so a rejected chunk can be retried.
+        new_pixels = (len(self._partial_pixel) + len(data)) // channels
+        if self.pixels_fed + new_pixels > self.width*self.height:
+            raise ValueError(f'Too much pixel data. Exp: {self.width*self.height} pixels, Act: {self.pixels_fed + new_pixels}')
+
+        # Complete a pixel left over from the previous chunk first.
+        head = b''
+        if self._partial_pixel:
+            needed = channels - len(self._partial_pixel)
+            self._partial_pixel += data[:needed]
+            data = data[needed:]
+            if len(self._partial_pixel) == channels:
+                head = bytes(self._partial_pixel)
+                self._partial_pixel.clear()
+        count = len(data) // channels
+        self._partial_pixel += data[count*channels:]
+
+        self.pixels_fed += new_pixels
+
+        # +1 for a QOI_OP_RUN carried over from the previous chunk.
+        output = bytearray((0 if self._header_sent else QOI_HEADER_SIZE) + 1 + new_pixels*(channels+1))
+        pos = 0
+        if not self._header_sent:
+            pack_into('>4sIIBB', output, 0, b'qoif', self.width, self.height, channels, self.colorspace)
+            pos = QOI_HEADER_SIZE
+            self._header_sent = True
+
+        state = (pos, self._prev_pixel, self._run_count)
+        for chunk in (memoryview(head), data[:count*channels]):
+            for pixels in packed_chunks(chunk, channels, len(chunk)//channels):
+                state = encode_pixel_ops(pixels, output, state[0], self._indexed_pixels, state[1], state[2])
+        (pos, self._prev_pixel, self._run_count) = state
+
+        return bytes(memoryview(output)[:pos])
+
+    def finish(self) -> bytes:
+        if self._finished:
+            raise ValueError('finish() called twice.')
+        if self._partial_pixel or self.pixels_fed != self.width*self.height:
+            raise ValueError(f'Not enough pixel data. Exp: {self.width*self.height*self.channels} bytes, Act: {self.pixels_fed*self.channels + len(self._partial_pixel)}')
+        self._finished = True
+        output = bytearray(1 + len(QOI_END_MARKER))
+        return bytes(memoryview(output)[:encode_end(output, 0, self._run_count)])
+
+
+def qoi_encode_pyramid(
+        width: int,
+        height: int,
+        data: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA,
+        levels=3) -> list[bytes]:
+    # Encodes the image and levels-1 successively halved (2x2 box filtered,
+    # ceil sized) versions of it in a single pass over the input: every
+    # level has its own QoiEncoder, and each pair of rows of a level is
+    # averaged down into one row of the next as soon as both are there.
+    data = byte_view(data)
+    check_encode_args(width, height, data, channels, colorspace, BACKEND_PYTHON)
+    if levels < 1:
+        raise ValueError('levels must be at least 1.')
+
+    sizes = [(width, height)]
+    for _ in range(levels - 1):
+        (w, h) = sizes[-1]
+        sizes.append((-(-w // 2), -(-h // 2)))
+    encoders = [QoiEncoder(w, h, channels, colorspace) for (w, h) in sizes]
+    outputs = [[] for _ in sizes]
+    bands = [bytearray() for _ in sizes]  # Rows of each level not averaged down yet.
+
+    def push(level, rows):
+        outputs[level].append(encoders[level].feed(rows))
+        if level + 1 < levels:
+            band = bands[level]
+            band += rows
+            band_size = 2*sizes[level][0]*channels
+            while len(band) >= band_size:
+                push(level + 1, box_filter(band[:band_size], sizes[level][0], channels, 2))
+                del band[:band_size]
+
+    row_size = width*channels
+    for y in range(0, height, 2):
+        push(0, data[y*row_size:min(y+2, height)*row_size])
+    # Odd heights leave a single row to average down at each level.
+    for level in range(levels - 1):
+        if bands[level]:
+            push(level + 1, box_filter(bytes(bands[level]), sizes[level][0], channels, 2))
+            bands[level].clear()
+
+    return [b''.join([*output, encoder.finish()]) for (output, encoder) in zip(outputs, encoders)]
+
+
+class QoiHeader(NamedTuple):
+    width: int
+    height: int
+    channels: int
+    colorspace: int
+
+    @property
+    def raw_size(self) -> int:
+        # Size of the decoded pixel data in bytes.
+        return self.width*self.height*self.channels
+
+
+def unpack_header(data: Buffer) -> QoiHeader:
+    if len(data) < QOI_HEADER_SIZE:
+        raise ValueError(f'data is too short. Exp: {QOI_HEADER_SIZE}, Act: {len(data)}')
+    (magic, width, height, channels, colorspace) = unpack_from('>4sIIBB', data, 0)
     if magic != b'qoif':
         raise ValueError('qoi file invalid!')
-    if footer != b'\x00\x00\x00\x00\x00\x00\x00\x01':
-        warnings.warn(f'data footer invalid! ({footer!r})', RuntimeWarning)
-
     if channels not in (3, 4):
         raise ValueError(f'Encoded channels invalid! ({channels})')
 
-    data_iter = iter(data[14:-8])  # The slice excludes the header and footer
-    indexed_pixels = [(0, 0, 0, 0)] * 64
-    pixel = (0, 0, 0, 255)
-    for tag in data_iter:
-        prev_pixel = pixel
-        if tag == TAG_QOI_OP_RGB:
-            pixel = (
-                next(data_iter),
-                next(data_iter),
-                next(data_iter),
-                prev_pixel[3],
-            )
-        elif tag == TAG_QOI_OP_RGBA:
-            pixel = (
-                next(data_iter),
-                next(data_iter),
-                next(data_iter),
-                next(data_iter),
-            )
-        elif (tag & TAG_QOI_2B_MASK) == TAG_QOI_OP_INDEX:
-            index = tag & 0x3f
-            pixel = indexed_pixels[index]
-        elif (tag & TAG_QOI_2B_MASK) == TAG_QOI_OP_DIFF:
-            pixel = (
-                u8_arith(prev_pixel[0] + ((tag >> 4) & 0x3) - 2),
-                u8_arith(prev_pixel[1] + ((tag >> 2) & 0x3) - 2),
-                u8_arith(prev_pixel[2] + (tag & 0x3) - 2),
-                prev_pixel[3],
-            )
-        elif (tag & TAG_QOI_2B_MASK) == TAG_QOI_OP_LUMA:
-            dg = (tag & 0x3f) - 32
-
-            diffs = next(data_iter)
-            dr_dg = ((diffs >> 4) & 0xf) - 8
-            db_dg = (diffs & 0xf) - 8
-
-            pixel = (
-                u8_arith(prev_pixel[0] + dr_dg + dg),
-                u8_arith(prev_pixel[1] + dg),
-                u8_arith(prev_pixel[2] + db_dg + dg),
-                prev_pixel[3],
-            )
-        else:  # TAG_QOI_OP_RUN: it must be this option; no need to check
-            pixel = prev_pixel
-            run_len_biased = tag & 0x3f
-            # run_len_biased has bias of -1.
-            # The last pixel will be stored after block.
-            output.extend(repeat(pixel, run_len_biased))
-
-        output.append(pixel)
-        indexed_pixels[qoi_index_position(*pixel)] = pixel
+    return QoiHeader(width, height, channels, colorspace)
+
+
+def qoi_read_header(source: Union[str, PathLike, BinaryIO, Buffer]) -> QoiHeader:
+    # Only the 14 header bytes are read from a path or file object; the
+    # file object is left positioned right after the header.
+    if isinstance(source, (str, PathLike)):
+        with open(source, 'rb') as f:
+            return unpack_header(f.read(QOI_HEADER_SIZE))
+    if hasattr(source, 'read'):
+        return unpack_header(source.read(QOI_HEADER_SIZE))
+    return unpack_header(byte_view(source)[:QOI_HEADER_SIZE])
+
+
+def strip_trailer(data: memoryview) -> memoryview:
+    # The qoi data without an embedded checkpoint index, which follows the
+    # end marker as packed checkpoints, INDEX_TRAILER_MAGIC and their size
+    # (u32, big-endian) as the very last bytes.
+    if len(data) < QOI_HEADER_SIZE + 2*len(QOI_END_MARKER):
+        return data
+    (magic, size) = unpack_from('>4sI', data, len(data)-8)
+    end = len(data) - 8 - size
+    if magic != INDEX_TRAILER_MAGIC or end < QOI_HEADER_SIZE + len(QOI_END_MARKER):
+        return data
+    if data[end-len(QOI_END_MARKER):end] != QOI_END_MARKER:
+        return data
+    return data[:end]
+
 
+def read_header(data: memoryview) -> QoiHeader:
+    header = unpack_header(data)
+    (footer,) = unpack_from('8s', data, len(data)-8)
+    if footer != QOI_END_MARKER:
+        warnings.warn(f'data footer invalid! ({footer!r})', RuntimeWarning)
+
+    return header
+
+
+def decode_ops(body: memoryview, output: Buffer, total_pixels: int, channels: int) -> int:
+    # Decodes the op stream into output (channels bytes per pixel) and
+    # returns the number of pixels written.
+    (consumed, written, pixel) = decode_pixel_ops(
+        body, output, 0, total_pixels, channels, array('I', bytes(4*64)), pack_pixel(0, 0, 0, 255))
+    if written < total_pixels:
+        warnings.warn(f'data ended early! Exp: {total_pixels} pixels, Act: {written}', RuntimeWarning)
+
+    return written
+
+
+# Pixels decode_pixel_ops collects before storing them to the output.
+STORE_PIXELS = 1 << 12
+
+
+def write_segments(spans: Iterable[tuple[int, int]], pos: int, end: int) -> Iterator[tuple[int, bool]]:
+    # Splits pixels pos..end-1 into (limit, write) segments for
+    # decode_pixel_ops: the pixels up to limit are written or only decoded.
+    # Written segments are at most STORE_PIXELS long, so the collected pixels
+    # are stored at least that often.
+    for (start, stop) in spans:
+        start = min(start, end)
+        stop = min(stop, end)
+        if start > pos:
+            yield (start, False)
+            pos = start
+        while stop > pos:
+            pos = min(stop, pos + STORE_PIXELS)
+            yield (pos, True)
+    if end > pos:
+        yield (end, False)
+
+
+def store_pixels(pixels: list, output: Buffer, out: int, channels: int) -> int:
+    # Stores the collected RGBA tuples to output from pixel out on, clears
+    # them and returns the output pixel that follows.
+    data = bytearray(chain.from_iterable(pixels))
+    end = out + len(pixels)
     if channels == CHANNELS_RGBA:
-        return bytes(chain.from_iterable(output))
-    # 3 Channels: take every value except the alpha.
-    return bytes(compress(chain.from_iterable(output), cycle((1, 1, 1, 0))))
+        output[out*4:end*4] = data
+    else:
+        output[out*3:end*3:3] = data[0::4]
+        output[out*3+1:end*3:3] = data[1::4]
+        output[out*3+2:end*3:3] = data[2::4]
+    pixels.clear()
+    return end
+
+
+def decode_pixel_ops(
+        body: memoryview,
+        output: Buffer,
+        pos: int,
+        end: int,
+        channels: int,
+        indexed_pixels: array,
+        pixel: int,
+        window: Union[Iterable[tuple[int, int]], None] = None) -> tuple[int, int, int]:
+    # Decodes ops from body into output pixels pos..end-1, stopping early at
+    # an op that is cut off at the end of body. The decoder state
+    # (indexed_pixels is updated in place, pixel) carries over between calls;
+    # returns (bytes of body consumed, new pos, pixel).
+    #
+    # With a window, only the pixels of its (start, stop) spans (increasing,
+    # from pos on) are written, one after the other from output pixel 0; the
+    # others are decoded for the state but never stored.
+    if pos >= end:
+        return 0, pos, pixel
+    segments = write_segments(((pos, end),) if window is None else window, pos, end)
+    (limit, write) = next(segments)
+    # Decoded pixels are collected and stored in one go per segment or
+    # STORE_PIXELS (store_pixels), which is cheaper than a store per pixel.
+    pixels = []
+    append = pixels.append
+    stored = pos if window is None else 0
+
+    # The state is kept as RGBA tuples in the loop. An INDEX op only picks
+    # the tuple; r, g, b and a are unpacked from it (stale) only for an op
+    # that needs them. Unset index slots are zero, an identity check away.
+    zero = (0, 0, 0, 0)
+    index = [unpack_pixel(v) if v else zero for v in indexed_pixels]
+    px = unpack_pixel(pixel)
+    (r, g, b, a) = px
+    stale = False
+    # Every pixel is in the index once decoded, except the initial one before
+    # any op; so only a run can need to store it, and only the first.
+    unindexed = index[(r*3 + g*5 + b*7 + a*11) % 64] != px
+
+    # Ops aren't counted: the bytes consumed follow from the pixels decoded
+    # (one per op, plus the extra ones of runs) and the op argument bytes.
+    # An op cut off at the end of body raises StopIteration before px (the
+    # state that is returned) is updated.
+    (start, run_extra, args) = (pos, 0, 0)
+    data_iter = iter(body)
+    try:
+        for tag in data_iter:
+            if tag < 0x40:  # QOI_OP_INDEX
+                px = index[tag]
+                if px is zero:  # The only pixel that isn't at its own slot.
+                    index[0] = zero
+                stale = True
+            elif tag == 0xfe:  # QOI_OP_RGB
+                if stale:
+                    (r, g, b, a) = px
+                    stale = False
+                r = next(data_iter)
+                g = next(data_iter)
+                b = next(data_iter)
+                args += 3
+                px = (r, g, b, a)
+                index[(r*3 + g*5 + b*7 + a*11) % 64] = px  # qoi_index_position
+            elif tag == 0xff:  # QOI_OP_RGBA
+                r = next(data_iter)
+                g = next(data_iter)
+                b = next(data_iter)
+                a = next(data_iter)
+                args += 4
+                stale = False
+                px = (r, g, b, a)
+                index[(r*3 + g*5 + b*7 + a*11) % 64] = px
+            elif tag < 0x80:  # QOI_OP_DIFF
+                if stale:
+                    (r, g, b, a) = px
+                    stale = False
+                # u8_arith, inlined
+                r = (r + (tag >> 4) - 6) & 0xff  # (tag >> 4) & 0x3 - 2
+                g = (g + ((tag >> 2) & 0x3) - 2) & 0xff
+                b = (b + (tag & 0x3) - 2) & 0xff
+                px = (r, g, b, a)
+                index[(r*3 + g*5 + b*7 + a*11) % 64] = px
+            elif tag < 0xc0:  # QOI_OP_LUMA
+                diffs = next(data_iter)
+                args += 1
+                if stale:
+                    (r, g, b, a) = px
+                    stale = False
+                dg = tag - 0xa0  # (tag & 0x3f) - 32
+                r = (r + dg + (diffs >> 4) - 8) & 0xff
+                g = (g + dg) & 0xff
+                b = (b + dg + (diffs & 0xf) - 8) & 0xff
+                px = (r, g, b, a)
+                index[(r*3 + g*5 + b*7 + a*11) % 64] = px
+            else:  # TAG_QOI_OP_RUN: it must be this option; no need to check
+                n = min(tag - 0xbf, end - pos)  # bias -1
+                run_extra += n - 1
+                if unindexed:
+                    if stale:
+                        (r, g, b, a) = px
+                        stale = False
+                    index[(r*3 + g*5 + b*7 + a*11) % 64] = px
+                    unindexed = False
+                # The pixel is unchanged, so collect the whole run at once
+                # (per segment it spans).
+                while True:
+                    k = min(n, limit - pos)
+                    if write:
+                        pixels += [px] * k
+                    pos += k
+                    n -= k
+                    if pos < limit or pos >= end:
+                        break
+                    (limit, write) = next(segments)
+                    if len(pixels) >= STORE_PIXELS:
+                        stored = store_pixels(pixels, output, stored, channels)
+                    if not n:
+                        break
+                if pos >= end:
+                    break
+                continue
+
+            if write:
+                append(px)
+            pos += 1
+            if pos >= limit:
+                if pos >= end:
+                    break
+                (limit, write) = next(segments)
+                if len(pixels) >= STORE_PIXELS:
+                    stored = store_pixels(pixels, output, stored, channels)
+    except StopIteration:
+        pass
+
+    if pixels:
+        store_pixels(pixels, output, stored, channels)
+    indexed_pixels[:] = array('I', [pack_pixel(*v) for v in index])
+
+    return pos - start - run_extra + args, pos, pack_pixel(*px)
+
+
+# Entries a PixelTable holds before it starts over.
+PIXEL_TABLE_LIMIT = 1 << 14
+# Pixels converted per step, which bounds the temporary copies.
+CONVERT_CHUNK_PIXELS = 1 << 16
+
+
+class PixelTable(dict):
+    # Cache of convert(r, g, b, a) per packed pixel, so each distinct color
+    # is converted once and repeats are a C-level dict lookup. It is cleared
+    # when full, so noise can't grow it without bound.
+
+    def __init__(self, convert):
+        super().__init__()
+        self._convert = convert
+
+    def __missing__(self, pixel: int):
+        if len(self) >= PIXEL_TABLE_LIMIT:
+            self.clear()
+        value = self[pixel] = self._convert(*unpack_pixel(pixel))
+        return value
+
+
+# Computed output layouts: (array typecode, convert(r, g, b, a)). The
+# converters are plain arithmetic, so they also work on NumPy arrays.
+PIXEL_CONVERTERS = {
+    LAYOUT_GRAY: ('B', lambda r, g, b, a: (r*299 + g*587 + b*114 + 500) // 1000),
+    LAYOUT_RGB565: ('H', lambda r, g, b, a: (r >> 3) << 11 | (g >> 2) << 5 | b >> 3),
+    LAYOUT_RGBA_PREMULTIPLIED: ('I', lambda r, g, b, a: pack_pixel(
+        (r*a + 127) // 255, (g*a + 127) // 255, (b*a + 127) // 255, a)),
+}
+OUT_FORMATS = (LAYOUT_RGB, LAYOUT_RGBA, LAYOUT_BGR, LAYOUT_BGRA, LAYOUT_ARGB, LAYOUT_ALPHA, *PIXEL_CONVERTERS)
+out_pixel_size = lambda layout: array(PIXEL_CONVERTERS[layout][0]).itemsize if layout in PIXEL_CONVERTERS else len(layout)
+
+
+def convert_pixels(data: memoryview, channels: int, count: int, layout: str) -> bytes:
+    output = bytearray(count*out_pixel_size(layout))
+    convert_pixels_into(data, channels, count, layout, output, 0)
+    return bytes(output)
+
+
+def convert_pixels_into(
+        data: memoryview,
+        channels: int,
+        count: int,
+        layout: str,
+        output: bytearray,
+        offset: int,
+        table: Union[PixelTable, None] = None):
+    # Writes count decoded RGB(A) pixels, converted to layout, into output
+    # from byte offset on. Channel orders are C-level strided copies (a
+    # missing alpha is 255). The other layouts are computed
+    # CONVERT_CHUNK_PIXELS at a time, with NumPy if it is installed and
+    # through table (a PixelTable for the layout, shared between calls)
+    # otherwise.
+    order = 'rgba'[:channels]
+    size = out_pixel_size(layout)
+    if layout not in PIXEL_CONVERTERS:
+        for (i, channel) in enumerate(layout):
+            target = slice(offset + i, offset + count*size, size)
+            if channel in order:
+                output[target] = data[order.index(channel):count*channels:channels]
+            else:
+                output[target] = b'\xff' * count
+        return
+
+    (typecode, convert) = PIXEL_CONVERTERS[layout]
+    if table is None and np is None:
+        table = PixelTable(convert)
+    for start in range(0, count, CONVERT_CHUNK_PIXELS):
+        n = min(CONVERT_CHUNK_PIXELS, count - start)
+        chunk = data[start*channels:(start + n)*channels]
+        if np is not None:
+            pixels = np.frombuffer(chunk, dtype=np.uint8).reshape(n, channels).astype(np.uint32)
+            alpha = pixels[:, 3] if channels == CHANNELS_RGBA else 255
+            converted = convert(pixels[:, 0], pixels[:, 1], pixels[:, 2], alpha)
+            converted = converted.astype('<u2' if typecode == 'H' else typecode)
+        else:
+            converted = array(typecode, map(table.__getitem__, packed_pixels(chunk, channels, n)))
+            if typecode == 'H' and sys.byteorder == 'big':
+                converted.byteswap()
+        output[offset + start*size:offset + (start + n)*size] = memoryview(converted).cast('B')
+
+
+def decode_converted(data: memoryview, header: QoiHeader, layout: str, chunk_size=1 << 14) -> bytes:
+    # qoi_decode with out_format on the Python backend: the op data is
+    # decoded chunk_size bytes at a time into a scratch buffer and converted
+    # into the output from there, so the RGB(A) pixels of the whole image are
+    # never held.
+    (width, height, channels, colorspace) = header
+    size = out_pixel_size(layout)
+    total = width*height
+    output = bytearray(total*size)
+    table = PixelTable(PIXEL_CONVERTERS[layout][1]) if layout in PIXEL_CONVERTERS else None
+    # One byte of op data decodes to at most 62 pixels (QOI_OP_RUN), so runs
+    # are never cut at the end of a chunk.
+    scratch = bytearray(min(total, 62*chunk_size)*channels)
+    (body, indexed_pixels, pixel) = (data[QOI_HEADER_SIZE:-8], array('I', bytes(4*64)), pack_pixel(0, 0, 0, 255))
+    (offset, written) = (0, 0)
+    while written < total:
+        chunk = body[offset:offset + chunk_size]
+        (consumed, count, pixel) = decode_pixel_ops(
+            chunk, scratch, 0, min(total - written, 62*len(chunk)), channels, indexed_pixels, pixel)
+        if count == 0:
+            break
+        convert_pixels_into(scratch, channels, count, layout, output, written*size, table)
+        offset += consumed
+        written += count
+    if written < total:
+        warnings.warn(f'data ended early! Exp: {total} pixels, Act: {written}', RuntimeWarning)
+        del output[written*size:]
+    return bytes(output)
+
+
+def qoi_decode(data: Buffer, backend=BACKEND_PYTHON, out_format=None) -> bytes:
+    data = strip_trailer(byte_view(data))
+    header = read_header(data)
+    (width, height, channels, colorspace) = header
+    if backend not in (BACKEND_PYTHON, BACKEND_NUMPY):
+        raise ValueError(f'backend must be BACKEND_PYTHON ({BACKEND_PYTHON!r}) or BACKEND_NUMPY ({BACKEND_NUMPY!r}).')
+    if out_format is not None and out_format not in OUT_FORMATS:
+        raise ValueError(f'out_format must be None or one of {OUT_FORMATS}.')
+
+    # The slices below exclude the header and footer without copying.
+    if backend == BACKEND_NUMPY and np is not None:
+        decoded = decode_ops_numpy(data[14:-8], width*height, channels)
+        if decoded is not None:
+            if out_format is not None:
+                return convert_pixels(memoryview(decoded.ravel()), channels, decoded.size // channels, out_format)
+            return decoded.tobytes()
+
+    if out_format is not None:
+        return decode_converted(data, header, out_format)
+
+    # The output is allocated once from the header and filled in place.
+    output = bytearray(width*height*channels)
+    written = decode_ops(data[14:-8], output, width*height, channels)
+    del output[written*channels:]
+    return bytes(output)
+
+
+def qoi_decode_into(data: Buffer, out: Buffer, backend=BACKEND_PYTHON) -> QoiHeader:
+    data = strip_trailer(byte_view(data))
+    header = read_header(data)
+    (width, height, channels, colorspace) = header
+    if backend not in (BACKEND_PYTHON, BACKEND_NUMPY):
+        raise ValueError(f'backend must be BACKEND_PYTHON ({BACKEND_PYTHON!r}) or BACKEND_NUMPY ({BACKEND_NUMPY!r}).')
+
+    output = byte_view(out)
+    if output.readonly:
+        raise ValueError('out must be a writable buffer.')
+    if len(output) < width*height*channels:
+        raise ValueError(f'out is too small. Exp: {width*height*channels}, Act: {len(output)}')
+
+    if backend == BACKEND_NUMPY and np is not None:
+        decoded = decode_ops_numpy(data[14:-8], width*height, channels)
+        if decoded is not None:
+            np.frombuffer(output, dtype=np.uint8, count=decoded.size)[:] = decoded.ravel()
+            return header
+
+    decode_ops(data[14:-8], output, width*height, channels)
+    return header
+
+
+def qoi_encode_file(
+        path: Union[str, PathLike],
+        width: int,
+        height: int,
+        data: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA,
+        backend=BACKEND_PYTHON) -> int:
+    # The file is sized to the worst case, encoded into through a memory map
+    # and then truncated to the bytes actually written, which are returned.
+    # Arguments are checked before the file is touched, and a file left
+    # half-written by a failed encode is removed.
+    data = byte_view(data)
+    check_encode_args(width, height, data, channels, colorspace, backend)
+    size = qoi_max_encoded_size(width, height, channels)
+    opened = False
+    try:
+        with open(path, 'w+b') as f:
+            opened = True  # Only a file this call created or truncated is removed.
+            f.truncate(size)
+            with mmap.mmap(f.fileno(), size) as mapped, memoryview(mapped) as view, releasing_views():
+                written = qoi_encode_into(width, height, data, view, channels, colorspace, backend)
+            f.truncate(written)
+    except BaseException:
+        if opened:
+            os.remove(path)
+        raise
+    return written
+
+
+def qoi_decode_file(path: Union[str, PathLike], backend=BACKEND_PYTHON) -> bytes:
+    # The file is memory mapped, so the qoi data is never read into memory
+    # as a whole.
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, releasing_views():
+        return qoi_decode(mapped, backend)
+
+
+class QoiCheckpoint(NamedTuple):
+    # Decoder state right before the op at byte offset (from the start of the
+    # qoi data), which decodes starting at pixel. prev_pixel and the 64
+    # indexed_pixels are RGBA bytes.
+    offset: int
+    pixel: int
+    prev_pixel: bytes
+    indexed_pixels: bytes
+
+
+# The decoder state before the first op.
+START_CHECKPOINT = QoiCheckpoint(QOI_HEADER_SIZE, 0, bytes((0, 0, 0, 255)), bytes(4*64))
+
+
+def qoi_encode_with_checkpoints(
+        width: int,
+        height: int,
+        data: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA,
+        every_rows=16,
+        every_pixels=None) -> tuple[bytes, bytes]:
+    # Returns the (unchanged, standard) qoi data and a sidecar checkpoint
+    # index with a checkpoint every every_pixels pixels (every_rows rows by
+    # default); see pack_checkpoints.
+    data = byte_view(data)
+    check_encode_args(width, height, data, channels, colorspace, BACKEND_PYTHON)
+    every = every_rows*width if every_pixels is None else every_pixels
+    if every < 1:
+        raise ValueError('checkpoint interval must be at least 1 pixel.')
+
+    output = bytearray(qoi_max_encoded_size(width, height, channels))
+    pack_into('>4sIIBB', output, 0, b'qoif', width, height, channels, colorspace)
+    indexed_pixels = array('I', bytes(4*64))
+    (pos, prev_pixel, run_count) = (QOI_HEADER_SIZE, pack_pixel(0, 0, 0, 255), 0)
+    checkpoints = []
+    for start in range(0, width*height, every):
+        # A pending run is written at pos too, so the next op starts
+        # run_count pixels back (all of them equal to prev_pixel).
+        if not checkpoints or checkpoints[-1].offset != pos:
+            checkpoints.append(QoiCheckpoint(
+                pos, start - run_count, prev_pixel.to_bytes(4, sys.byteorder), indexed_pixels.tobytes()))
+        n = min(every, width*height - start)
+        for pixels in packed_chunks(data[start*channels:(start + n)*channels], channels, n):
+            (pos, prev_pixel, run_count) = encode_pixel_ops(pixels, output, pos, indexed_pixels, prev_pixel, run_count)
+    size = encode_end(output, pos, run_count)
+
+    return bytes(memoryview(output)[:size]), pack_checkpoints(checkpoints)
+
+
+def pack_checkpoints(checkpoints: list[QoiCheckpoint]) -> bytes:
+    # Sidecar layout: magic, checkpoint count (u32), then CHECKPOINT_FORMAT
+    # per checkpoint, all big-endian.
+    output = bytearray(8 + calcsize(CHECKPOINT_FORMAT)*len(checkpoints))
+    pack_into('>4sI', output, 0, CHECKPOINTS_MAGIC, len(checkpoints))
+    for (i, checkpoint) in enumerate(checkpoints):
+        pack_into(CHECKPOINT_FORMAT, output, 8 + calcsize(CHECKPOINT_FORMAT)*i, *checkpoint)
+    return bytes(output)
+
+
+def unpack_checkpoints(data: Buffer) -> list[QoiCheckpoint]:
+    data = byte_view(data)
+    if len(data) < 8:
+        raise ValueError(f'checkpoint data is too short. Exp: 8, Act: {len(data)}')
+    (magic, count) = unpack_from('>4sI', data, 0)
+    if magic != CHECKPOINTS_MAGIC:
+        raise ValueError('checkpoint data invalid!')
+    size = 8 + calcsize(CHECKPOINT_FORMAT)*count
+    if len(data) < size:
+        raise ValueError(f'checkpoint data is too short. Exp: {size}, Act: {len(data)}')
+    return [QoiCheckpoint(*unpack_from(CHECKPOINT_FORMAT, data, 8 + calcsize(CHECKPOINT_FORMAT)*i))
+            for i in range(count)]
+
+
+def qoi_embed_checkpoints(data: Buffer, checkpoints: Union[list[QoiCheckpoint], Buffer]) -> bytes:
+    # Appends checkpoints after the end marker (see strip_trailer), replacing
+    # any embedded ones. Decoders that stop after the end marker still read
+    # the result as a standard qoi file.
+    data = strip_trailer(byte_view(data))
+    read_header(data)
+    packed = pack_checkpoints(checkpoints) if isinstance(checkpoints, list) else bytes(byte_view(checkpoints))
+    unpack_checkpoints(packed)  # Validates it.
+    return b''.join((data, packed, INDEX_TRAILER_MAGIC, len(packed).to_bytes(4, 'big')))
+
+
+def qoi_read_checkpoints(data: Buffer) -> Union[list[QoiCheckpoint], None]:
+    # The checkpoints embedded by qoi_embed_checkpoints, None without any.
+    data = byte_view(data)
+    end = len(strip_trailer(data))
+    if end == len(data):
+        return None
+    return unpack_checkpoints(data[end:-8])
+
+
+def nearest_checkpoint(checkpoints: list[QoiCheckpoint], pixel: int) -> QoiCheckpoint:
+    # The last checkpoint at or before pixel (checkpoints are in pixel order).
+    i = bisect_right([checkpoint.pixel for checkpoint in checkpoints], pixel)
+    if i == 0:
+        raise ValueError(f'no checkpoint at or before pixel {pixel}.')
+    return checkpoints[i-1]
+
+
+def qoi_decode_from(data: Buffer, checkpoint: QoiCheckpoint, end=None) -> bytes:
+    # Decodes pixels checkpoint.pixel..end-1 (to the last pixel by default)
+    # starting at the checkpoint's op instead of the first one.
+    data = strip_trailer(byte_view(data))
+    (width, height, channels, colorspace) = read_header(data)
+    end = width*height if end is None else min(end, width*height)
+    if not QOI_HEADER_SIZE <= checkpoint.offset <= len(data) - len(QOI_END_MARKER):
+        raise ValueError(f'checkpoint offset out of range! ({checkpoint.offset})')
+    if not 0 <= checkpoint.pixel <= end:
+        raise ValueError(f'checkpoint pixel out of range! ({checkpoint.pixel})')
+
+    count = end - checkpoint.pixel
+    output = bytearray(count*channels)
+    (consumed, written, pixel) = decode_pixel_ops(
+        data[checkpoint.offset:-8], output, 0, count, channels,
+        array('I', checkpoint.indexed_pixels), int.from_bytes(checkpoint.prev_pixel, sys.byteorder))
+    if written < count:
+        warnings.warn(f'data ended early! Exp: {count} pixels, Act: {written}', RuntimeWarning)
+        del output[written*channels:]
+
+    return bytes(output)
+
+
+def qoi_decode_region(
+        data: Buffer,
+        x: int,
+        y: int,
+        w: int,
+        h: int,
+        checkpoints: Union[list[QoiCheckpoint], Buffer, None] = None) -> bytes:
+    # Decodes only the w*h rectangle at (x, y). Decoding starts at the
+    # nearest checkpoint before the region if checkpoints (a list or packed
+    # sidecar data) are given or embedded in data, and stops after its last
+    # row.
+    data = byte_view(data)
+    if checkpoints is None:
+        checkpoints = qoi_read_checkpoints(data)
+    data = strip_trailer(data)
+    (width, height, channels, colorspace) = read_header(data)
+    if not (0 <= x and 0 <= y and 0 < w and 0 < h and x + w <= width and y + h <= height):
+        raise ValueError(f'region out of bounds! Exp: within {width}x{height}, Act: {w}x{h} at ({x}, {y})')
+
+    if checkpoints is None:
+        checkpoint = START_CHECKPOINT
+    else:
+        if not isinstance(checkpoints, list):
+            checkpoints = unpack_checkpoints(checkpoints)
+        checkpoint = nearest_checkpoint(checkpoints, y*width + x)
+
+    # One pass from the checkpoint to the region's last pixel, which only
+    # stores the pixels of its rows.
+    output = bytearray(w*h*channels)
+    starts = range(y*width + x, (y + h)*width, width)
+    (consumed, pos, pixel) = decode_pixel_ops(
+        data[checkpoint.offset:-8], output, checkpoint.pixel, starts[-1] + w, channels,
+        array('I', checkpoint.indexed_pixels), int.from_bytes(checkpoint.prev_pixel, sys.byteorder),
+        window=((start, start + w) for start in starts))
+    if pos < starts[-1] + w:
+        written = sum(min(max(pos - start, 0), w) for start in starts)
+        warnings.warn(f'data ended early! Exp: {w*h} pixels, Act: {written}', RuntimeWarning)
+
+    return bytes(output)
+
+
+def qoi_decode_thumbnail(data: Buffer, factor=2, average=False) -> bytes:
+    # Decodes a ceil(width/factor) x ceil(height/factor) preview: the
+    # top-left pixel of each factor x factor block, or the block's average.
+    # Only the preview is allocated; the full image never is.
+    data = strip_trailer(byte_view(data))
+    (width, height, channels, colorspace) = read_header(data)
+    if factor < 1:
+        raise ValueError('factor must be at least 1.')
+
+    (thumb_width, thumb_height) = (-(-width // factor), -(-height // factor))
+    output = bytearray(thumb_width*thumb_height*channels)
+    if not average:
+        # One pass that only stores the sampled pixels, each a window span
+        # of its own, and stops after the last one.
+        starts = [y*width + x for y in range(0, height, factor) for x in range(0, width, factor)]
+        (consumed, pos, pixel) = decode_pixel_ops(
+            data[QOI_HEADER_SIZE:-8], output, 0, starts[-1] + 1, channels,
+            array('I', bytes(4*64)), pack_pixel(0, 0, 0, 255), window=((start, start + 1) for start in starts))
+        if pos <= starts[-1]:
+            warnings.warn(f'data ended early! Exp: {len(starts)} pixels, Act: {bisect_right(starts, pos - 1)}', RuntimeWarning)
+        return bytes(output)
+
+    # Average each band of factor rows down.
+    thumb_row_size = thumb_width*channels
+    (rows, band) = (0, bytearray())
+    for (row_y, row) in decode_rows(data, width*channels):
+        rows += 1
+        band += row
+        if row_y % factor == factor - 1 or row_y == height - 1:
+            o = row_y // factor * thumb_row_size
+            output[o:o + thumb_row_size] = box_filter(band, width, channels, factor)
+            band.clear()
+    if band:
+        o = rows // factor * thumb_row_size
+        output[o:o + thumb_row_size] = box_filter(band, width, channels, factor)
+    if rows < height:
+        warnings.warn(f'data ended early! Exp: {width*height} pixels, Act: {rows*width}', RuntimeWarning)
+    return bytes(output)
+
+
+def box_filter(rows: Buffer, width: int, channels: int, factor: int) -> bytes:
+    # Averages (rounded) every factor pixels of up to factor rows into one
+    # row of ceil(width/factor) pixels. Blocks at the right edge are smaller.
+    row_size = width*channels
+    out_width = -(-width // factor)
+    height = len(rows) // row_size
+    # The sums are done on big integers with a 32-bit lane per byte (padded
+    # to whole blocks), which adds all columns at once at C speed: first the
+    # rows, then the pixels of each block, shifted onto its first pixel.
+    lanes = bytearray(4*out_width*factor*channels)
+    total = 0
+    for j in range(height):
+        lanes[0:4*row_size:4] = rows[j*row_size:(j+1)*row_size]
+        total += int.from_bytes(lanes, 'little')
+    block_total = 0
+    for k in range(factor):
+        block_total += total >> (32*channels*k)
+    sums = array('I', block_total.to_bytes(len(lanes), 'little'))
+    if sys.byteorder == 'big':
+        sums.byteswap()
+
+    output = bytearray(out_width*channels)
+    count = height*factor
+    for c in range(channels):
+        output[c::channels] = bytes([(s + count // 2) // count for s in sums[c::factor*channels]])
+    if width % factor:
+        count = height*(width % factor)
+        for c in range(channels):
+            output[c - channels] = (sums[(out_width-1)*factor*channels + c] + count // 2) // count
+    return bytes(output)
+
+
+def decode_rows(data: memoryview, row_size: int, chunk_size=1 << 14) -> Iterator[tuple[int, memoryview]]:
+    # Yields (y, row) for every complete row of row_size bytes, decoding data
+    # (qoi data without a trailer) in chunks with a QoiDecoder. Stops early on
+    # cut-off data; rows are only valid until the next one is requested.
+    decoder = QoiDecoder()
+    y = 0
+    for start in range(0, len(data), chunk_size):
+        with memoryview(decoder.feed(data[start:start + chunk_size])) as rows:
+            for o in range(0, len(rows), row_size):
+                yield (y, rows[o:o + row_size])
+                y += 1
+
+
+class QoiDecoder:
+    # Incremental decoder: qoi data is fed in arbitrarily sized chunks and
+    # complete pixel rows are returned as soon as they are decoded. Only the
+    # decoder state, a partial row and a partial op are kept between chunks.
+
+    def __init__(self):
+        self.width = None
+        self.height = None
+        self.channels = None
+        self.colorspace = None
+        self.pixels_decoded = 0
+        self._pending = bytearray()
+        self._partial_row = bytearray()
+        self._pixel = pack_pixel(0, 0, 0, 255)
+        self._indexed_pixels = array('I', bytes(4*64))
+        self._finished = False
+
+    def feed(self, data: Buffer) -> bytes:
+        if self._finished:
+            raise ValueError('feed() called after finish().')
+        self._pending += byte_view(data)
+
+        if self.width is None:
+            if len(self._pending) < QOI_HEADER_SIZE:
+                return b''
+            (self.width, self.height, self.channels, self.colorspace) = unpack_header(self._pending)
+            del self._pending[:QOI_HEADER_SIZE]
+
+        (width, channels) = (self.width, self.channels)
+        remaining = width*self.height - self.pixels_decoded
+        if remaining == 0:
+            del self._pending[len(QOI_END_MARKER):]  # Only the end marker is still of interest.
+            return b''
+
+        # One byte of op data decodes to at most 62 pixels (QOI_OP_RUN).
+        start = len(self._partial_row) // channels
+        end = start + min(remaining, 62*len(self._pending))
+        output = bytearray(end*channels)
+        output[:len(self._partial_row)] = self._partial_row
+        with memoryview(self._pending) as body:
+            (consumed, pos, self._pixel) = decode_pixel_ops(
+                body, output, start, end, channels, self._indexed_pixels, self._pixel)
+        del self._pending[:consumed]
+        self.pixels_decoded += pos - start
+
+        rows_end = (pos // width) * width * channels
+        self._partial_row = output[rows_end:pos*channels]
+        return bytes(memoryview(output)[:rows_end])
+
+    def finish(self):
+        if self._finished:
+            raise ValueError('finish() called twice.')
+        self._finished = True
+        if self.width is None or self.pixels_decoded < self.width*self.height:
+            raise ValueError(f'data ended early! Exp: {(self.width or 0)*(self.height or 0)} pixels, Act: {self.pixels_decoded}')
+        footer = bytes(self._pending[:len(QOI_END_MARKER)])
+        if footer != QOI_END_MARKER:
+            warnings.warn(f'data footer invalid! ({footer!r})', RuntimeWarning)
+
+
+def qoi_decode_to_file(
+        src: Union[str, PathLike, BinaryIO],
+        dst: Union[str, PathLike, BinaryIO],
+        format=FORMAT_RAW,
+        chunk_size=1 << 14) -> QoiHeader:
+    # Streams the decoded rows to dst as they are produced; memory use is the
+    # decoder state plus what one chunk of src decodes to.
+    if format not in (FORMAT_RAW, FORMAT_PAM, FORMAT_PPM):
+        raise ValueError(f'format must be FORMAT_RAW ({FORMAT_RAW!r}), FORMAT_PAM ({FORMAT_PAM!r}) or FORMAT_PPM ({FORMAT_PPM!r}).')
+
+    with ExitStack() as stack:
+        if isinstance(src, (str, PathLike)):
+            src = stack.enter_context(open(src, 'rb'))
+        if isinstance(dst, (str, PathLike)):
+            dst = stack.enter_context(open(dst, 'wb'))
+
+        decoder = QoiDecoder()
+        header_written = False
+        while chunk := src.read(chunk_size):
+            rows = decoder.feed(chunk)
+            if not header_written and decoder.width is not None:
+                if format == FORMAT_PAM:
+                    tupltype = 'RGB_ALPHA' if decoder.channels == CHANNELS_RGBA else 'RGB'
+                    dst.write(f'P7\nWIDTH {decoder.width}\nHEIGHT {decoder.height}\nDEPTH {decoder.channels}\nMAXVAL 255\nTUPLTYPE {tupltype}\nENDHDR\n'.encode('ascii'))
+                elif format == FORMAT_PPM:
+                    dst.write(f'P6\n{decoder.width} {decoder.height}\n255\n'.encode('ascii'))
+                header_written = True
+            if rows and format == FORMAT_PPM and decoder.channels == CHANNELS_RGBA:
+                rgb = bytearray(len(rows)//4*3)
+                rgb[0::3] = rows[0::4]
+                rgb[1::3] = rows[1::4]
+                rgb[2::3] = rows[2::4]
+                rows = rgb
+            if rows:
+                dst.write(rows)
+        decoder.finish()
+
+    return QoiHeader(decoder.width, decoder.height, decoder.channels, decoder.colorspace)
+
+
+def run_pool_tasks(
+        worker,
+        costs: list[int],
+        prepare,
+        finish,
+        discard,
+        workers,
+        chunksize,
+        batch_size: int,
+        memory_budget,
+        ordered: bool) -> Iterator:
+    # Shared scheduling of qoi_encode_many and qoi_decode_many. costs[i] is
+    # the shared memory job i needs (from width*height*channels), so jobs are
+    # started largest first and nothing waits behind one huge image at the
+    # end. Consecutive jobs are batched into one task up to batch_size bytes
+    # (and chunksize jobs), so small images don't pay for a round trip each.
+    # At most memory_budget bytes are held at once, counting results that
+    # wait for their turn. A single job larger than the budget, or the job
+    # the waiting results need next, may still run alone.
+    # prepare(i) builds (task, resources) for job i in the parent just
+    # before it is sent, worker runs a list of tasks in a worker process,
+    # finish(resources, result) makes the value yielded for a job and
+    # discard(resources) cleans up a job that never finished. Yields values
+    # in job order, or (job index, value) as they complete if not ordered.
+    workers = workers or os.cpu_count() or 1
+    if chunksize is not None and chunksize < 1:
+        raise ValueError('chunksize must be at least 1.')
+
+    order = sorted(range(len(costs)), key=lambda i: -costs[i])
+    started = [False]*len(costs)
+    in_flight = {}  # future -> (job indices, resources of each job)
+    prepared = []  # resources of the batch being built, for cleanup
+    finished = {}  # job index -> value, waiting for its turn if ordered
+    # Memory of the jobs running or finished but not yielded yet; results
+    # waiting for their turn still count against memory_budget.
+    (next_job, next_index, in_use) = (0, 0, 0)
+
+    with ProcessPoolExecutor(workers) as pool:
+        try:
+            while next_job < len(order) or in_flight:
+                while next_job < len(order) and len(in_flight) < 2*workers:
+                    (indices, batch_cost) = ([], 0)
+                    while next_job < len(order) and len(indices) != chunksize:
+                        index = order[next_job]
+                        if started[index]:
+                            next_job += 1
+                            continue
+                        cost = costs[index]
+                        if indices and batch_cost + cost > batch_size:
+                            break
+                        if (memory_budget is not None and (in_flight or indices or finished)
+                                and in_use + batch_cost + cost > memory_budget):
+                            break
+                        indices.append(index)
+                        started[index] = True
+                        batch_cost += cost
+                        next_job += 1
+                    if not indices:
+                        if in_flight or next_job == len(order):
+                            break  # Over budget; wait for a task to finish.
+                        # Over budget with only results waiting for job
+                        # next_index, which hasn't started yet: run it alone.
+                        indices = [next_index]
+                        started[next_index] = True
+                        batch_cost = costs[next_index]
+
+                    tasks = []
+                    for index in indices:
+                        (task, resources) = prepare(index)
+                        tasks.append(task)
+                        prepared.append(resources)
+                    in_flight[pool.submit(worker, tasks)] = (indices, prepared)
+                    prepared = []
+                    in_use += batch_cost
+
+                for future in wait(in_flight, return_when=FIRST_COMPLETED).done:
+                    (indices, resources) = in_flight[future]
+                    results = future.result()
+                    del in_flight[future]
+                    for (index, job_resources, result) in zip(indices, resources, results):
+                        finished[index] = finish(job_resources, result)
+
+                if not ordered:
+                    while finished:
+                        (index, value) = finished.popitem()
+                        in_use -= costs[index]
+                        yield (index, value)
+                while next_index in finished:
+                    in_use -= costs[next_index]
+                    yield finished.pop(next_index)
+                    next_index += 1
+        finally:
+            for future in in_flight:
+                future.cancel()
+            wait(in_flight)
+            for (_, resources) in in_flight.values():
+                for job_resources in resources:
+                    discard(job_resources)
+            for job_resources in prepared:
+                discard(job_resources)
+
+
+def free_shared(*blocks: SharedMemory):
+    for block in blocks:
+        if block is not None:
+            block.close()
+            block.unlink()
+
+
+def encode_shared_batch(tasks: list[tuple]) -> list[bytes]:
+    # Runs in a worker process of qoi_encode_many: each task's pixel data is
+    # read straight from the shared memory block the parent filled.
+    results = []
+    for (name, size, width, height, channels, colorspace, backend) in tasks:
+        shared = SharedMemory(name=name)
+        try:
+            with shared.buf[:size] as data, releasing_views():
+                results.append(qoi_encode(width, height, data, channels, colorspace, backend))
+        finally:
+            shared.close()
+    return results
+
+
+def qoi_encode_many(
+        jobs: Iterable[tuple],
+        workers=None,
+        chunksize=None,
+        batch_size=1 << 20,
+        memory_budget=None,
+        ordered=True,
+        backend=BACKEND_PYTHON) -> Iterator:
+    # Each job is a tuple of qoi_encode arguments:
+    # (width, height, data[, channels[, colorspace]]). Pixel data is handed
+    # to the worker processes through multiprocessing.shared_memory instead
+    # of being pickled, scheduled by run_pool_tasks. Yields the encoded bytes
+    # in job order, or (job index, encoded bytes) as they complete if not
+    # ordered.
+    args = []
+    for (width, height, data, *options) in jobs:
+        channels = options[0] if len(options) > 0 else CHANNELS_RGB
+        colorspace = options[1] if len(options) > 1 else COLORSPACE_SRGB_WITH_LINEAR_ALPHA
+        data = byte_view(data)
+        check_encode_args(width, height, data, channels, colorspace, backend)
+        args.append((width, height, data, channels, colorspace))
+
+    def prepare(index):
+        (width, height, data, channels, colorspace) = args[index]
+        size = width*height*channels
+        block = SharedMemory(create=True, size=size)
+        block.buf[:size] = data[:size]
+        return ((block.name, size, width, height, channels, colorspace, backend), block)
+
+    def finish(block, encoded):
+        free_shared(block)
+        return encoded
+
+    costs = [width*height*channels for (width, height, _, channels, _) in args]
+    return run_pool_tasks(
+        encode_shared_batch, costs, prepare, finish, free_shared,
+        workers, chunksize, batch_size, memory_budget, ordered)
+
+
+class QoiSharedImage:
+    # A decoded image of qoi_decode_many, living in shared memory. data is a
+    # zero-copy view of the pixels; close() (or leaving a with block) frees
+    # them once no views or arrays of the data are left.
+
+    def __init__(self, header: QoiHeader, block: SharedMemory):
+        self.header = header
+        self.data = block.buf[:header.raw_size]
+        self._block = block
+
+    def as_numpy(self) -> 'np.ndarray':
+        # A (height, width, channels) uint8 array sharing memory with data.
+        if np is None:
+            raise ImportError('QoiSharedImage.as_numpy() requires NumPy.')
+        (width, height, channels, _) = self.header
+        return np.frombuffer(self.data, dtype=np.uint8).reshape(height, width, channels)
+
+    def close(self):
+        if self._block is not None:
+            self.data.release()
+            self._block.close()
+            self._block = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def decode_shared_batch(tasks: list[tuple]) -> list[list[tuple]]:
+    # Runs in a worker process of qoi_decode_many: pixels are decoded
+    # straight into the shared memory block the parent created. The qoi data
+    # is a file path (memory mapped here) or another shared memory block.
+    # Warnings (e.g. data that ended early) would stay in the worker, so the
+    # (message, category) of each are returned for the parent to re-issue.
+    results = []
+    for (source, out_name, backend) in tasks:
+        with ExitStack() as stack, warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            if isinstance(source, tuple):
+                (in_name, in_size) = source
+                shared_in = SharedMemory(name=in_name)
+                stack.callback(shared_in.close)
+                data = stack.enter_context(shared_in.buf[:in_size])
+            else:
+                f = stack.enter_context(open(source, 'rb'))
+                data = stack.enter_context(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+            shared_out = SharedMemory(name=out_name)
+            stack.callback(shared_out.close)
+            out = stack.enter_context(memoryview(shared_out.buf))
+            stack.enter_context(releasing_views())
+            qoi_decode_into(data, out, backend)
+        results.append([(str(warning.message), warning.category) for warning in caught])
+    return results
+
+
+def qoi_decode_many(
+        sources: Iterable[Union[str, PathLike, Buffer]],
+        workers=None,
+        chunksize=None,
+        batch_size=1 << 20,
+        memory_budget=None,
+        ordered=True,
+        backend=BACKEND_PYTHON) -> Iterator:
+    # Each source is a path or a buffer of qoi data. Workers decode into
+    # multiprocessing.shared_memory, so the pixels are never pickled or
+    # copied back. Scheduled by run_pool_tasks on the header sizes. Yields a
+    # QoiSharedImage per source in order, or (source index, QoiSharedImage)
+    # as they complete if not ordered.
+    sources = [os.fspath(source) if isinstance(source, (str, PathLike)) else byte_view(source) for source in sources]
+    headers = [qoi_read_header(source) for source in sources]
+
+    def prepare(index):
+        (source, header) = (sources[index], headers[index])
+        shared_in = None
+        if not isinstance(source, str):
+            shared_in = SharedMemory(create=True, size=len(source))
+            shared_in.buf[:len(source)] = source
+            source = (shared_in.name, len(source))
+        try:
+            shared_out = SharedMemory(create=True, size=header.raw_size)
+        except BaseException:
+            free_shared(shared_in)
+            raise
+        return ((source, shared_out.name, backend), (header, shared_in, shared_out))
+
+    def finish(resources, caught):
+        (header, shared_in, shared_out) = resources
+        free_shared(shared_in)
+        for (message, category) in caught:
+            warnings.warn(message, category)
+        shared_out.unlink()  # The mapping stays valid until QoiSharedImage.close().
+        return QoiSharedImage(header, shared_out)
+
+    def discard(resources):
+        free_shared(*resources[1:])
+
+    costs = [header.raw_size + (0 if isinstance(source, str) else len(source))
+             for (source, header) in zip(sources, headers)]
+    return run_pool_tasks(
+        decode_shared_batch, costs, prepare, finish, discard,
+        workers, chunksize, batch_size, memory_budget, ordered)
+
+
+class QoiTiledHeader(NamedTuple):
+    width: int
+    height: int
+    tile_width: int
+    tile_height: int
+    channels: int
+    colorspace: int
+
+    @property
+    def columns(self) -> int:
+        return -(-self.width // self.tile_width)
+
+    @property
+    def rows(self) -> int:
+        return -(-self.height // self.tile_height)
+
+    def tile_rect(self, column: int, row: int) -> tuple[int, int, int, int]:
+        # (x, y, width, height) of a tile; edge tiles may be smaller.
+        (x, y) = (column*self.tile_width, row*self.tile_height)
+        return (x, y, min(self.tile_width, self.width - x), min(self.tile_height, self.height - y))
+
+
+def crop_pixels(data: memoryview, width: int, channels: int, x: int, y: int, w: int, h: int) -> bytes:
+    row_size = width*channels
+    return b''.join(data[(y+j)*row_size + x*channels:(y+j)*row_size + (x+w)*channels] for j in range(h))
+
+
+def tiled_encode(
+        width: int,
+        height: int,
+        data: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA,
+        tile_width=256,
+        tile_height=256,
+        workers=None,
+        backend=BACKEND_PYTHON) -> bytes:
+    # "qoi-tiled" container: TILED_HEADER_FORMAT, a directory with a
+    # TILE_ENTRY_FORMAT (offset from the start of the container, length) per
+    # tile in row-major order, then the tiles, each a standard qoi image.
+    # Tiles are encoded on a qoi_encode_many pool if workers is given.
+    data = byte_view(data)
+    check_encode_args(width, height, data, channels, colorspace, backend)
+    if tile_width <= 0 or tile_height <= 0:
+        raise ValueError('tile_width and tile_height must be larger than 0.')
+
+    header = QoiTiledHeader(width, height, tile_width, tile_height, channels, colorspace)
+    rects = [header.tile_rect(column, row) for row in range(header.rows) for column in range(header.columns)]
+    jobs = [(w, h, crop_pixels(data, width, channels, x, y, w, h), channels, colorspace) for (x, y, w, h) in rects]
+    if workers is None:
+        tiles = [qoi_encode(*job, backend=backend) for job in jobs]
+    else:
+        tiles = list(qoi_encode_many(jobs, workers, backend=backend))
+
+    offset = calcsize(TILED_HEADER_FORMAT) + calcsize(TILE_ENTRY_FORMAT)*len(tiles)
+    output = bytearray(offset)
+    pack_into(TILED_HEADER_FORMAT, output, 0, TILED_MAGIC, *header)
+    for (i, tile) in enumerate(tiles):
+        pack_into(TILE_ENTRY_FORMAT, output, calcsize(TILED_HEADER_FORMAT) + calcsize(TILE_ENTRY_FORMAT)*i, offset, len(tile))
+        offset += len(tile)
+    return b''.join([output, *tiles])
+
+
+def unpack_tiled(data: memoryview) -> tuple[QoiTiledHeader, list[tuple[int, int]]]:
+    # The header and the (offset, length) of each tile.
+    if len(data) < calcsize(TILED_HEADER_FORMAT):
+        raise ValueError(f'data is too short. Exp: {calcsize(TILED_HEADER_FORMAT)}, Act: {len(data)}')
+    (magic, *fields) = unpack_from(TILED_HEADER_FORMAT, data, 0)
+    if magic != TILED_MAGIC:
+        raise ValueError('qoi-tiled file invalid!')
+    header = QoiTiledHeader(*fields)
+    if header.tile_width == 0 or header.tile_height == 0:
+        raise ValueError('qoi-tiled file invalid!')
+
+    count = header.columns*header.rows
+    size = calcsize(TILED_HEADER_FORMAT) + calcsize(TILE_ENTRY_FORMAT)*count
+    if len(data) < size:
+        raise ValueError(f'data is too short. Exp: {size}, Act: {len(data)}')
+    directory = [unpack_from(TILE_ENTRY_FORMAT, data, calcsize(TILED_HEADER_FORMAT) + calcsize(TILE_ENTRY_FORMAT)*i)
+                 for i in range(count)]
+    for (offset, length) in directory:
+        if offset + length > len(data):
+            raise ValueError(f'tile out of range! Exp: <= {len(data)}, Act: {offset + length}')
+    return header, directory
+
+
+def tiled_decode_tile(data: Buffer, column: int, row: int, backend=BACKEND_PYTHON) -> bytes:
+    # Decodes a single tile; no other tile data is read.
+    data = byte_view(data)
+    (header, directory) = unpack_tiled(data)
+    if not (0 <= column < header.columns and 0 <= row < header.rows):
+        raise ValueError(f'tile out of range! Exp: within {header.columns}x{header.rows}, Act: ({column}, {row})')
+    (offset, length) = directory[row*header.columns + column]
+    return qoi_decode(data[offset:offset+length], backend)
+
+
+def tiled_decode(data: Buffer, workers=None, backend=BACKEND_PYTHON) -> bytes:
+    # Decodes the whole image, on a qoi_decode_many pool if workers is given.
+    data = byte_view(data)
+    (header, directory) = unpack_tiled(data)
+    (width, channels) = (header.width, header.channels)
+    tiles = [data[offset:offset+length] for (offset, length) in directory]
+
+    output = bytearray(header.width*header.height*channels)
+
+    def place(i, pixels):
+        (x, y, w, h) = header.tile_rect(i % header.columns, i // header.columns)
+        for j in range(h):
+            o = ((y+j)*width + x)*channels
+            output[o:o + w*channels] = pixels[j*w*channels:(j+1)*w*channels]
+
+    if workers is None:
+        for (i, tile) in enumerate(tiles):
+            place(i, qoi_decode(tile, backend))
+    else:
+        for (i, image) in qoi_decode_many(tiles, workers, ordered=False, backend=backend):
+            with image:
+                place(i, image.data)
+    return bytes(output)
+
+
+def tiled_from_qoi(data: Buffer, tile_width=256, tile_height=256, workers=None, backend=BACKEND_PYTHON) -> bytes:
+    # Lossless conversion of a standard qoi image to qoi-tiled.
+    data = strip_trailer(byte_view(data))
+    (width, height, channels, colorspace) = read_header(data)
+    return tiled_encode(
+        width, height, qoi_decode(data, backend), channels, colorspace, tile_width, tile_height, workers, backend)
+
+
+def tiled_to_qoi(data: Buffer, workers=None, backend=BACKEND_PYTHON) -> bytes:
+    # Lossless conversion of qoi-tiled to a standard qoi image.
+    (header, _) = unpack_tiled(byte_view(data))
+    return qoi_encode(
+        header.width, header.height, tiled_decode(data, workers, backend), header.channels, header.colorspace,
+        backend, workers)
+
+
+def qoi_encode_numpy(
+        width: int,
+        height: int,
+        data: Buffer,
+        channels=CHANNELS_RGB,
+        colorspace=COLORSPACE_SRGB_WITH_LINEAR_ALPHA) -> bytes:
+    # Vectorized equivalent of the pure Python loop in encode_ops; the output
+    # is byte-identical. Arguments are expected to be validated by qoi_encode.
+    if np is None:
+        raise ImportError('qoi_encode_numpy requires NumPy.')
+    TOTAL_PIXELS = width*height
+
+    rgba = np.empty((TOTAL_PIXELS, 4), dtype=np.uint8)
+    rgba[:, :channels] = np.frombuffer(data, dtype=np.uint8, count=TOTAL_PIXELS*channels).reshape(-1, channels)
+    if channels == CHANNELS_RGB:
+        rgba[:, 3] = 255
+    prev_rgba = np.empty_like(rgba)
+    prev_rgba[0] = (0, 0, 0, 255)
+    prev_rgba[1:] = rgba[:-1]
+
+    # Pixels equal to the previous pixel are covered by QOI_OP_RUN.
+    packed = rgba.view(np.uint32).ravel()
+    is_run = packed == prev_rgba.view(np.uint32).ravel()
+
+    # Every other pixel either already is in the index or is written to it,
+    # so the index entry it is compared against is simply the previous non-run
+    # pixel with the same hash (or the zeroed initial entry).
+    ops = np.flatnonzero(~is_run)
+    op_packed = packed[ops]
+    op_rgba = rgba[ops].astype(np.int16)
+    op_prev = prev_rgba[ops].astype(np.int16)
+    r, g, b, a = op_rgba.T
+    index_position = (r*3 + g*5 + b*7 + a*11) % 64  # qoi_index_position
+    order = np.argsort(index_position, kind='stable')
+    sorted_position = index_position[order]
+    sorted_packed = op_packed[order]
+    indexed = np.zeros_like(sorted_packed)
+    same_slot = sorted_position[1:] == sorted_position[:-1]
+    indexed[1:][same_slot] = sorted_packed[:-1][same_slot]
+    is_index = np.empty(len(ops), dtype=bool)
+    is_index[order] = sorted_packed == indexed
+
+    is_rgba = ~is_index & (a != op_prev[:, 3])
+    delta = (op_rgba[:, :3] - op_prev[:, :3] + 128) % 256 - 128  # s8_arith
+    dr, dg, db = delta.T
+    dr_dg = (dr - dg + 128) % 256 - 128
+    db_dg = (db - dg + 128) % 256 - 128
+    rest = ~is_index & ~is_rgba
+    is_diff = rest & np.all((-2 <= delta) & (delta <= 1), axis=1)
+    rest &= ~is_diff
+    is_luma = rest & (-32 <= dg) & (dg <= 31) & (-8 <= dr_dg) & (dr_dg <= 7) & (-8 <= db_dg) & (db_dg <= 7)
+    is_rgb = rest & ~is_luma
+
+    # Byte size of each pixel's op(s). A stretch of L run pixels is emitted
+    # at its last pixel as ceil(L/62) QOI_OP_RUN bytes.
+    sizes = np.zeros(TOTAL_PIXELS, dtype=np.int64)
+    sizes[ops] = np.select([is_index, is_diff, is_luma, is_rgb], [1, 1, 2, 4], 5)
+    edges = np.diff(np.concatenate(([0], is_run.view(np.int8), [0])))
+    run_starts = np.flatnonzero(edges == 1)
+    run_ends = np.flatnonzero(edges == -1)
+    run_lens = run_ends - run_starts
+    run_ops = (run_lens + 61) // 62
+    sizes[run_ends-1] = run_ops
+    offsets = np.cumsum(sizes) - sizes
+    body_size = int(offsets[-1] + sizes[-1])
+
+    output = np.empty(QOI_HEADER_SIZE + body_size + len(QOI_END_MARKER), dtype=np.uint8)
+    pack_into('>4sIIBB', output, 0, b'qoif', width, height, channels, colorspace)
+    output[QOI_HEADER_SIZE+body_size:] = np.frombuffer(QOI_END_MARKER, dtype=np.uint8)
+    body = output[QOI_HEADER_SIZE:QOI_HEADER_SIZE+body_size]
+
+    # Full runs of 62 (62 bias -1 => 61) are the default; each stretch ends
+    # with its remainder.
+    body[:] = TAG_QOI_OP_RUN | 61
+    body[offsets[run_ends-1] + run_ops - 1] = TAG_QOI_OP_RUN | (run_lens - 62*(run_ops-1) - 1)
+
+    op_offsets = offsets[ops]
+    tags = np.select(
+        [is_index, is_diff, is_luma, is_rgb],
+        [
+            TAG_QOI_OP_INDEX | index_position,
+            TAG_QOI_OP_DIFF | (dr+2)<<4 | (dg+2)<<2 | (db+2),
+            TAG_QOI_OP_LUMA | (dg+32),
+            TAG_QOI_OP_RGB,
+        ],
+        TAG_QOI_OP_RGBA)
+    body[op_offsets] = tags
+    body[op_offsets[is_luma]+1] = ((dr_dg+8)<<4 | (db_dg+8))[is_luma]
+    is_full = is_rgb | is_rgba
+    for channel in range(3):
+        body[op_offsets[is_full]+1+channel] = op_rgba[is_full, channel]
+    body[op_offsets[is_rgba]+4] = a[is_rgba]
+
+    return output.tobytes()
+
+
+def op_offsets_numpy(body: 'np.ndarray') -> 'np.ndarray':
+    # Every byte is treated as a potential op start pointing at the next one;
+    # the real op starts are the bytes reachable from offset 0. Reachability
+    # is found by pointer doubling, so only log2(len(body)) passes are needed.
+    n = len(body)
+    op_len = np.ones(n+1, dtype=np.int64)
+    op_len[:n][(body & TAG_QOI_2B_MASK) == TAG_QOI_OP_LUMA] = 2
+    op_len[:n][body == TAG_QOI_OP_RGB] = 4
+    op_len[:n][body == TAG_QOI_OP_RGBA] = 5
+    next_op = np.minimum(np.arange(n+1) + op_len, n)
+    is_start = np.zeros(n+1, dtype=bool)
+    is_start[0] = True
+    span = 1
+    while span <= n:
+        is_start[next_op[is_start]] = True
+        next_op = next_op[next_op]
+        span *= 2
+    return np.flatnonzero(is_start[:n])
+
+
+def resolve_roots_numpy(parent: 'np.ndarray', offset=None):
+    # Pointer doubling until every entry points at a root (parent[i] == i),
+    # accumulating offsets along the way.
+    while True:
+        grandparent = parent[parent]
+        if np.array_equal(grandparent, parent):
+            return parent, offset
+        if offset is not None:
+            offset = offset + offset[parent]
+        parent = grandparent
+
+
+def decode_ops_numpy(body: Buffer, total_pixels: int, channels: int, max_passes=8):
+    # Returns an (n, channels) uint8 array with n <= total_pixels, or None if
+    # the Python decoder is the better choice: for INDEX-heavy streams, or if
+    # the index references stop settling or did not settle within max_passes.
+    body = np.frombuffer(body, dtype=np.uint8)
+    starts = op_offsets_numpy(body)
+    if len(starts):
+        # Like decode_pixel_ops, stop before an op cut off at the end of body.
+        tag = int(body[starts[-1]])
+        if tag == TAG_QOI_OP_RGBA:
+            op_len = 5
+        elif tag == TAG_QOI_OP_RGB:
+            op_len = 4
+        else:
+            op_len = 2 if (tag & TAG_QOI_2B_MASK) == TAG_QOI_OP_LUMA else 1
+        if starts[-1] + op_len > len(body):
+            starts = starts[:-1]
+
+    tags = body[starts]
+    counts = np.where((tags & TAG_QOI_2B_MASK == TAG_QOI_OP_RUN) & (tags < TAG_QOI_OP_RGB), (tags & 0x3f) + 1, 1)
+    ends = np.cumsum(counts)
+    n_ops = min(int(np.searchsorted(ends, total_pixels)) + 1, len(starts))
+    if n_ops == 0:
+        warnings.warn(f'data ended early! Exp: {total_pixels} pixels, Act: 0', RuntimeWarning)
+        return np.empty((0, channels), dtype=np.uint8)
+    starts = starts[:n_ops]
+    tags = tags[:n_ops]
+    counts = counts[:n_ops]
+    counts[-1] -= max(0, int(ends[n_ops-1]) - total_pixels)
+    # Every INDEX op adds to each pass below, so palette-like streams are
+    # faster in the Python loop even when they settle in one pass.
+    if np.count_nonzero(tags < TAG_QOI_OP_DIFF) > n_ops*NUMPY_MAX_INDEX_SHARE:
+        return None
+    op_byte = lambda k, mask: body[starts[mask] + k]
+
+    is_rgb = tags == TAG_QOI_OP_RGB
+    is_rgba = tags == TAG_QOI_OP_RGBA
+    is_full = is_rgb | is_rgba
+    is_index = (tags & TAG_QOI_2B_MASK) == TAG_QOI_OP_INDEX
+    is_diff = (tags & TAG_QOI_2B_MASK) == TAG_QOI_OP_DIFF
+    is_luma = (tags & TAG_QOI_2B_MASK) == TAG_QOI_OP_LUMA
+
+    # All channel math is mod 256 (and the hash mod 64), so uint8 wrapping
+    # does the u8_arith for free.
+    delta = np.zeros((n_ops, 3), dtype=np.uint8)
+    diff_tags = tags[is_diff]
+    delta[is_diff, 0] = ((diff_tags >> 4) & 0x3) - 2
+    delta[is_diff, 1] = ((diff_tags >> 2) & 0x3) - 2
+    delta[is_diff, 2] = (diff_tags & 0x3) - 2
+    dg = (tags[is_luma] & 0x3f) - 32
+    diffs = op_byte(1, is_luma)
+    delta[is_luma, 0] = dg + ((diffs >> 4) & 0xf) - 8
+    delta[is_luma, 1] = dg
+    delta[is_luma, 2] = dg + (diffs & 0xf) - 8
+    delta_sums = np.cumsum(delta, axis=0, dtype=np.uint8)
+    delta_hash_sums = np.cumsum(
+        delta[:, 0]*np.uint8(3) + delta[:, 1]*np.uint8(5) + delta[:, 2]*np.uint8(7), dtype=np.uint8)
+
+    full_rgb = np.stack([op_byte(1, is_full), op_byte(2, is_full), op_byte(3, is_full)], axis=1)
+    rgba_alpha = op_byte(4, is_rgba)
+
+    # Between "absolute" ops (RGB, RGBA, INDEX) the RGB channels are running
+    # sums of the DIFF/LUMA deltas; the alpha only changes at RGBA and INDEX.
+    # Segment 0 is the initial (0, 0, 0, 255) pixel.
+    rgb_segment = np.cumsum(is_full | is_index)
+    rgb_segment_starts = np.flatnonzero(is_full | is_index)
+    rgb_segment_sums = np.zeros((len(rgb_segment_starts)+1, 3), dtype=np.uint8)
+    rgb_segment_sums[1:] = delta_sums[rgb_segment_starts]
+    hash_segment_sums = np.zeros(len(rgb_segment_starts)+1, dtype=np.uint8)
+    hash_segment_sums[1:] = delta_hash_sums[rgb_segment_starts]
+    alpha_segment = np.cumsum(is_rgba | is_index)
+    alpha_roots = np.zeros(alpha_segment[-1]+1, dtype=np.uint8)
+    alpha_roots[0] = 255
+    alpha_roots[alpha_segment[is_rgba]] = rgba_alpha
+    rgb_roots = np.zeros((len(rgb_segment_starts)+1, 3), dtype=np.uint8)
+    rgb_roots[rgb_segment[is_full]] = full_rgb
+
+    index_ops = np.flatnonzero(is_index)
+    index_slots = tags[index_ops] & 0x3f
+    full_hash = (full_rgb[:, 0]*np.uint8(3) + full_rgb[:, 1]*np.uint8(5) + full_rgb[:, 2]*np.uint8(7))
+
+    # Only the INDEX ops need the sequential state. A pixel's hash can be
+    # followed through the deltas without its value, so guess each INDEX op's
+    # alpha and whether its slot was ever written, look up the op that last
+    # wrote the slot, recompute the alphas and repeat until nothing changes.
+    # The fixed point is the sequential result. Opaque streams settle in the
+    # first pass; with varying alpha each pass can only fix the ops whose
+    # hashes depend on alphas the previous one got wrong, so it takes more.
+    # A pass that changes as many guesses as the one before gives up.
+    alpha = alpha_roots[np.cumsum(is_rgba)]
+    found = np.ones(len(index_ops), dtype=bool)
+    # The last writer of each slot is searched for all INDEX ops at once, in
+    # slot order, which keeps the binary searches close together.
+    query_order = np.argsort(index_slots, kind='stable')
+    query_keys = (index_slots.astype(np.int64)*(n_ops+1) + index_ops)[query_order]
+    unsettled = n_ops + len(index_ops) + 1
+    for _ in range(max_passes):
+        segment_hash = np.zeros(len(rgb_segment_starts)+1, dtype=np.uint8)
+        segment_hash[0] = qoi_index_position(0, 0, 0, 255)
+        prev_alpha = np.empty_like(alpha)
+        prev_alpha[0] = 255
+        prev_alpha[1:] = alpha[:-1]
+        full_alpha = np.where(is_rgba[is_full], alpha[is_full], prev_alpha[is_full])
+        segment_hash[rgb_segment[is_full]] = full_hash + full_alpha*np.uint8(11)
+        segment_hash[rgb_segment[index_ops]] = np.where(found, index_slots, 0)
+        op_hash = ((segment_hash - hash_segment_sums)[rgb_segment] + delta_hash_sums) & 0x3f
+
+        order = np.argsort(op_hash, kind='stable')
+        last_write = np.empty(len(index_ops), dtype=np.int64)
+        last_write[query_order] = np.searchsorted(op_hash[order].astype(np.int64)*(n_ops+1) + order, query_keys) - 1
+        source = order[np.maximum(last_write, 0)]
+        new_found = (last_write >= 0) & (op_hash[source] == index_slots)
+        # An INDEX op that hit its own slot copies the previous writer of the
+        # slot (the one before it in order) unchanged, so chains of them are
+        # skipped here to the first other writer instead of in the pointer
+        # doubling below.
+        chained = np.zeros(n_ops, dtype=bool)
+        chained[index_ops[new_found & (op_hash[index_ops] == index_slots)]] = True
+        chain_start = np.maximum.accumulate(np.where(chained[order], -1, np.arange(n_ops)))
+        source = order[chain_start[np.maximum(last_write, 0)]][new_found]
+        source_segment = rgb_segment[source]
+
+        rgb_parent = np.arange(len(rgb_roots))
+        rgb_offset = np.zeros_like(rgb_roots)
+        rgb_parent[rgb_segment[index_ops[new_found]]] = source_segment
+        rgb_offset[rgb_segment[index_ops[new_found]]] = delta_sums[source] - rgb_segment_sums[source_segment]
+        rgb_parent, rgb_offset = resolve_roots_numpy(rgb_parent, rgb_offset)
+
+        alpha_parent = np.arange(len(alpha_roots))
+        alpha_parent[alpha_segment[index_ops[new_found]]] = alpha_segment[source]
+        alpha_parent, _ = resolve_roots_numpy(alpha_parent)
+        new_alpha = alpha_roots[alpha_parent][alpha_segment]
+
+        changed = np.count_nonzero(new_alpha != alpha) + np.count_nonzero(new_found != found)
+        if changed == 0:
+            break
+        if changed >= unsettled:
+            return None
+        (alpha, found, unsettled) = (new_alpha, new_found, changed)
+    else:
+        return None
+
+    values = np.empty((n_ops, channels), dtype=np.uint8)
+    segment_base = rgb_roots[rgb_parent] + rgb_offset - rgb_segment_sums
+    values[:, :3] = segment_base[rgb_segment] + delta_sums
+    if channels == CHANNELS_RGBA:
+        values[:, 3] = alpha
+
+    # Runs expand to their pixel counts.
+    decoded = np.repeat(values, counts, axis=0)
+    if len(decoded) < total_pixels:
+        warnings.warn(f'data ended early! Exp: {total_pixels} pixels, Act: {len(decoded)}', RuntimeWarning)
+    return decoded
+
+
+def qoi_decode_numpy(data: Buffer) -> 'np.ndarray':
+    if np is None:
+        raise ImportError('qoi_decode_numpy requires NumPy.')
+    data = strip_trailer(byte_view(data))
+    (width, height, channels, colorspace) = read_header(data)
+
+    decoded = decode_ops_numpy(data[14:-8], width*height, channels)
+    if decoded is None:
+        decoded = np.frombuffer(qoi_decode(data), dtype=np.uint8).reshape(-1, channels)
+    if len(decoded) < width*height:
+        decoded = np.concatenate([decoded, np.zeros((width*height - len(decoded), channels), dtype=np.uint8)])
+    return decoded.reshape(height, width, channels)
 
 
 if __name__ == '__main__':
@@ -234,4 +2135,159 @@ if __name__ == '__main__':
         f.write(qoi_out)
 
     decode_data = qoi_decode(qoi_out)
-    print(f'decode_data == data? {decode_data == data}')
\ No newline at end of file
+    print(f'decode_data == data? {decode_data == data}')
+
+    # Larger image, each feature checked against the BACKEND_PYTHON
+    # encode/decode of it.
+    tw = 97
+    th = 61
+    tcs = COLORSPACE_SRGB_WITH_LINEAR_ALPHA  # NOT REALLY USED.
+
+    # Flat blocks (RUN, INDEX), gradients (DIFF, LUMA) and hashed noise with
+    # varying alpha (RGB, RGBA).
+    data_tups = [
+        ((x // 8 * 40) % 256, (y // 8 * 60) % 256, 90, 255) if (x // 8 + y // 8) % 3 == 0 else
+        ((x + y) % 256, (2*x) % 256, (3*y) % 256, 255) if (x // 8 + y // 8) % 3 == 1 else
+        ((x*131 + y*71)**2 % 251, (x*17 + y*29)**3 % 253, (x*y*7) % 256, (x*y) % 2 * 127 + 128)
+        for y in range(th) for x in range(tw)]
+
+    for tch in (CHANNELS_RGB, CHANNELS_RGBA):
+        data = bytes(chain.from_iterable(pixel[:tch] for pixel in data_tups))
+        qoi_out = qoi_encode(tw, th, data, tch, tcs)
+        decode_data = qoi_decode(qoi_out)
+        print(f'{tch} channels: decode_data == data? {decode_data == data}')
+
+        # Called directly, as the image is far below MIN_STRIP_PIXELS.
+        strips_out = qoi_encode_strips(tw, th, memoryview(data), tch, tcs, 3)
+        print(f'{tch} channels: strips encode == python encode? {strips_out == qoi_out}')
+
+        numpy_out = qoi_encode(tw, th, data, tch, tcs, BACKEND_NUMPY)
+        print(f'{tch} channels: numpy encode == python encode? {numpy_out == qoi_out}')
+        numpy_data = qoi_decode(qoi_out, BACKEND_NUMPY)
+        print(f'{tch} channels: numpy decode == python decode? {numpy_data == decode_data}')
+
+        into_data = bytearray(tw*th*tch)
+        into_header = qoi_decode_into(qoi_out, into_data)
+        print(f'{tch} channels: qoi_decode_into == python decode? {into_data == decode_data and into_header.channels == tch}')
+        into_out = bytearray(qoi_max_encoded_size(tw, th, tch))
+        into_size = qoi_encode_into(tw, th, data, into_out, tch, tcs)
+        print(f'{tch} channels: qoi_encode_into == python encode? {into_out[:into_size] == qoi_out}')
+
+        # Odd chunk sizes split pixels, ops and the header.
+        encoder = QoiEncoder(tw, th, tch, tcs)
+        stream_out = b''.join(encoder.feed(data[i:i+7]) for i in range(0, len(data), 7)) + encoder.finish()
+        print(f'{tch} channels: QoiEncoder == python encode? {stream_out == qoi_out}')
+        decoder = QoiDecoder()
+        stream_data = b''.join(decoder.feed(qoi_out[i:i+5]) for i in range(0, len(qoi_out), 5))
+        decoder.finish()
+        print(f'{tch} channels: QoiDecoder == python decode? {stream_data == decode_data}')
+
+        with open(f'test_out_{tch}ch_big.qoi', 'wb') as f:
+            f.write(qoi_out)
+        with open(f'test_out_{tch}ch_big.qoi', 'rb') as f:
+            probes = (qoi_read_header(f'test_out_{tch}ch_big.qoi'), qoi_read_header(f), qoi_read_header(qoi_out))
+            probed_header_only = f.tell() == QOI_HEADER_SIZE
+        print(f'{tch} channels: qoi_read_header == header? {probed_header_only and all(p == (tw, th, tch, tcs) for p in probes)}')
+
+        file_size = qoi_encode_file(f'test_out_{tch}ch_file.qoi', tw, th, data, tch, tcs)
+        with open(f'test_out_{tch}ch_file.qoi', 'rb') as f:
+            file_out = f.read()
+        file_data = qoi_decode_file(f'test_out_{tch}ch_file.qoi')
+        print(f'{tch} channels: qoi_encode_file/qoi_decode_file == python encode/decode? '
+              f'{file_size == len(qoi_out) and file_out == qoi_out and file_data == decode_data}')
+
+        to_file_header = qoi_decode_to_file(f'test_out_{tch}ch_big.qoi', f'test_out_{tch}ch.raw', FORMAT_RAW, chunk_size=64)
+        with open(f'test_out_{tch}ch.raw', 'rb') as f:
+            to_file_data = f.read()
+        print(f'{tch} channels: qoi_decode_to_file == python decode? {to_file_data == decode_data and to_file_header.width == tw}')
+
+        many_out = list(qoi_encode_many([(tw, th, data, tch, tcs)]*3, workers=2))
+        print(f'{tch} channels: qoi_encode_many == python encode? {many_out == [qoi_out]*3}')
+        many_data = []
+        for image in qoi_decode_many([qoi_out, f'test_out_{tch}ch_big.qoi'], workers=2):
+            with image:
+                many_data.append(bytes(image.data))
+        print(f'{tch} channels: qoi_decode_many == python decode? {many_data == [decode_data]*2}')
+        # Warnings of a worker decode are re-issued in the parent.
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            for image in qoi_decode_many([qoi_out[:len(qoi_out)//2]], workers=2):
+                image.close()
+        print(f'{tch} channels: qoi_decode_many warns? {any(w.category is RuntimeWarning for w in caught)}')
+
+        # Mixed sizes under a budget of about one image; results come back as
+        # they complete.
+        jobs = [(tw, rows, data[:tw*rows*tch], tch, tcs) for rows in (5, th, 20, th, 1)]
+        budget_out = dict(qoi_encode_many(jobs, workers=2, batch_size=1, memory_budget=tw*th*tch, ordered=False))
+        print(f'{tch} channels: qoi_encode_many with memory_budget == python encode? '
+              f'{[budget_out[i] for i in range(len(jobs))] == [qoi_encode(*job) for job in jobs]}')
+
+        (checkpoint_out, checkpoint_index) = qoi_encode_with_checkpoints(tw, th, data, tch, tcs, every_pixels=50)
+        from_checkpoints = all(
+            qoi_decode_from(qoi_out, checkpoint) == decode_data[checkpoint.pixel*tch:]
+            for checkpoint in unpack_checkpoints(checkpoint_index))
+        print(f'{tch} channels: checkpoint decodes == python decode? {checkpoint_out == qoi_out and from_checkpoints}')
+
+        (x, y, w, h) = (13, 20, 40, 25)
+        region = b''.join(decode_data[((y + j)*tw + x)*tch:((y + j)*tw + x + w)*tch] for j in range(h))
+        regions = (qoi_decode_region(qoi_out, x, y, w, h), qoi_decode_region(qoi_out, x, y, w, h, checkpoint_index))
+        print(f'{tch} channels: region decodes == python decode? {all(r == region for r in regions)}')
+        embedded = qoi_embed_checkpoints(qoi_out, checkpoint_index)
+        embedded_ok = (
+            embedded.startswith(qoi_out) and qoi_decode(embedded) == decode_data
+            and qoi_read_checkpoints(qoi_out) is None
+            and qoi_read_checkpoints(embedded) == unpack_checkpoints(checkpoint_index)
+            and qoi_decode_region(embedded, x, y, w, h) == region)
+        print(f'{tch} channels: embedded checkpoints == python encode/decode? {embedded_ok}')
+
+        # 32x16 tiles leave partial tiles on the right and bottom edges.
+        tiled = tiled_encode(tw, th, data, tch, tcs, 32, 16, workers=2)
+        tile = b''.join(decode_data[((16 + j)*tw + 32)*tch:((16 + j)*tw + 64)*tch] for j in range(16))
+        tiled_ok = (
+            tiled_decode(tiled) == decode_data and tiled_decode(tiled, workers=2) == decode_data
+            and tiled_decode_tile(tiled, 1, 1) == tile and tiled_to_qoi(tiled_from_qoi(qoi_out, 32, 16)) == qoi_out)
+        print(f'{tch} channels: tiled decodes == python decode? {tiled_ok}')
+
+        thumbnail = b''.join(
+            decode_data[(j*tw + i)*tch:(j*tw + i + 1)*tch] for j in range(0, th, 4) for i in range(0, tw, 4))
+        # Rounded means of the 4x4 blocks, which shrink at the edges.
+        blocks = [
+            [decode_data[(jj*tw + ii)*tch:(jj*tw + ii + 1)*tch] for jj in range(j, min(j + 4, th)) for ii in range(i, min(i + 4, tw))]
+            for j in range(0, th, 4) for i in range(0, tw, 4)]
+        averaged = bytes(
+            (sum(pixel[c] for pixel in block) + len(block) // 2) // len(block) for block in blocks for c in range(tch))
+        print(f'{tch} channels: thumbnails == python decode? '
+              f'{qoi_decode_thumbnail(qoi_out, 4) == thumbnail and qoi_decode_thumbnail(qoi_out, 4, True) == averaged}')
+
+        # Each level is the 2x2 average thumbnail of the one before.
+        pyramid = qoi_encode_pyramid(tw, th, data, tch, tcs, levels=3)
+        pyramid_ok = pyramid[0] == qoi_out
+        for (level, smaller) in zip(pyramid, pyramid[1:]):
+            header = qoi_read_header(level)
+            half = qoi_encode(-(-header.width // 2), -(-header.height // 2), qoi_decode_thumbnail(level, 2, True), tch, tcs)
+            pyramid_ok = pyramid_ok and smaller == half
+        print(f'{tch} channels: pyramid levels == python encode of thumbnails? {pyramid_ok}')
+
+        bgra = bytes(chain.from_iterable(
+            (pixel[2], pixel[1], pixel[0], pixel[3] if tch == CHANNELS_RGBA else 255)
+            for pixel in (decode_data[i:i+tch] for i in range(0, len(decode_data), tch))))
+        # A cut off stream converts as many pixels as qoi_decode returns.
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            cut_pixels = len(qoi_decode(qoi_out[:len(qoi_out)//2])) // tch
+            cut_converted = [
+                len(qoi_decode(qoi_out[:len(qoi_out)//2], backend, LAYOUT_BGRA)) // 4
+                for backend in (BACKEND_PYTHON, BACKEND_NUMPY)]
+        out_format_ok = (
+            qoi_decode(qoi_out, out_format=LAYOUT_BGRA) == bgra
+            and qoi_decode(qoi_out, BACKEND_NUMPY, LAYOUT_BGRA) == bgra and cut_converted == [cut_pixels]*2)
+        print(f'{tch} channels: out_format decodes == python decode? {out_format_ok}')
+
+        # Alpha in the input is dropped for 3 channels.
+        layouts = {
+            LAYOUT_BGRA: bytes(chain.from_iterable((b, g, r, a) for (r, g, b, a) in data_tups)),
+            LAYOUT_ARGB: bytes(chain.from_iterable((a, r, g, b) for (r, g, b, a) in data_tups)),
+            LAYOUT_BGR if tch == CHANNELS_RGB else LAYOUT_RGBA: bytes(chain.from_iterable(
+                (b, g, r) if tch == CHANNELS_RGB else (r, g, b, a) for (r, g, b, a) in data_tups))}
+        layouts_ok = all(qoi_encode(tw, th, pixels, tch, tcs, layout=layout) == qoi_out for (layout, pixels) in layouts.items())
+        print(f'{tch} channels: layout encodes == python encode? {layouts_ok}')